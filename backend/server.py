@@ -1,44 +1,236 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Query, Request, UploadFile, File
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from dotenv import load_dotenv
+from starlette.concurrency import run_in_threadpool
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument, monitoring
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure
+from bson import json_util, encode as bson_encode
 import os
+import io
+import re
+import csv
+import gzip
+import json
+import zlib
+import base64
+import socket
+import ipaddress
+import asyncio
+import hashlib
 import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict, EmailStr
-from typing import List, Optional, Dict, Any
+from pydantic import BaseModel, Field, ConfigDict, EmailStr, computed_field
+from typing import List, Optional, Dict, Any, Callable, Awaitable
 import uuid
+from contextvars import ContextVar
 from datetime import datetime, timezone, timedelta
-from passlib.context import CryptContext
-from jose import JWTError, jwt
-from emergentintegrations.payments.stripe.checkout import (
-    StripeCheckout,
-    CheckoutSessionResponse,
-    CheckoutStatusResponse,
-    CheckoutSessionRequest
-)
 
 ROOT_DIR = Path(__file__).parent
-load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# passlib, python-jose, motor and the Stripe integration are imported where
+# they are first needed so that importing this module stays cheap and does
+# not require the environment or a database. See create_app().
+
+# --- Settings ---
+
+class Settings(BaseModel):
+    mongo_url: str
+    db_name: str
+    jwt_secret: str = 'your-secret-key-change-in-production'
+    stripe_api_key: Optional[str] = None
+    # Public URL of this API, used for absolute image links; defaults to the
+    # URL each request was made to
+    backend_url: str = ''
+    cors_origins: List[str] = ['*']
+    shed_loop_lag_ms: float = 250
+    shed_pool_waiters: int = 50
+    rate_limit_backend: str = 'memory'
+    rate_limit_trust_forwarded: bool = False
+    job_workers: int = 2
+    singleflight_max_waiters: int = 1000
+    image_cache_dir: str = str(ROOT_DIR / 'image_cache')
+    image_cache_max_mb: int = 512
+    # Data retention: age in days per collection (0 disables), and the
+    # collections purged by a TTL index instead of being archived
+    retention_days: Dict[str, int] = {"cart_items": 30, "orders": 90, "payment_transactions": 90}
+    retention_ttl_collections: List[str] = []
+    archive_target: str = 'file'  # 'file' (gzipped NDJSON) or 'collection' (archive_<name>)
+    archive_dir: str = str(ROOT_DIR / 'archive')
+    archive_batch_size: int = 500
+    archive_pause_ms: int = 200
+    archive_interval_hours: float = 24
+    facets_cache_seconds: float = 30
+    export_batch_size: int = 2000
+    # Accounts allowed on the admin reporting routes (analytics, exports)
+    admin_emails: List[str] = []
+
+    @classmethod
+    def from_env(cls) -> "Settings":
+        """Read settings from the environment (and backend/.env), one upper-cased variable per field."""
+        load_dotenv(ROOT_DIR / '.env')
+        values: Dict[str, Any] = {
+            name: os.environ[name.upper()] for name in cls.model_fields if name.upper() in os.environ
+        }
+        if 'REACT_APP_BACKEND_URL' in os.environ:
+            values['backend_url'] = os.environ['REACT_APP_BACKEND_URL']
+        if 'cors_origins' in values:
+            values['cors_origins'] = values['cors_origins'].split(',')
+        if 'retention_days' in values:
+            values['retention_days'] = json.loads(values['retention_days'])
+        if 'retention_ttl_collections' in values:
+            values['retention_ttl_collections'] = values['retention_ttl_collections'].split(',')
+        if 'admin_emails' in values:
+            values['admin_emails'] = [email.strip() for email in values['admin_emails'].split(',') if email.strip()]
+        return cls(**values)
+
+# --- Load shedding ---
+
+class PoolWaitQueueListener(monitoring.ConnectionPoolListener):
+    """Tracks how many operations are waiting for a Mongo connection."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.waiting = 0
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            self.waiting += 1
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self.waiting -= 1
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.waiting -= 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        pass
+
+    def connection_checked_in(self, event):
+        pass
+
+class LoadShedder:
+    """Rejects expensive requests while the event loop or the Mongo pool is saturated."""
+
+    def __init__(self, pool_listener: PoolWaitQueueListener, max_loop_lag: float, max_pool_waiters: int, interval: float = 0.1):
+        self.pool_listener = pool_listener
+        self.max_loop_lag = max_loop_lag
+        self.max_pool_waiters = max_pool_waiters
+        self.interval = interval
+        self.loop_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _monitor(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            sample = max(0.0, loop.time() - started - self.interval)
+            # Smoothed so that a single slow callback does not trigger shedding.
+            self.loop_lag = 0.7 * self.loop_lag + 0.3 * sample
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._monitor())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def overloaded(self) -> bool:
+        return self.loop_lag > self.max_loop_lag or self.pool_listener.waiting > self.max_pool_waiters
+
+# --- Runtime state ---
+
+# Each app built by create_app() owns a Runtime (settings, Mongo client,
+# queues, caches), stored on app.state.runtime. RuntimeMiddleware makes it
+# the active one for the app's requests and lifespan; tasks started from
+# there inherit it. The module-level names below resolve against the active
+# Runtime, so two apps in one process never share state.
+_active_runtime: ContextVar[Optional["Runtime"]] = ContextVar("active_runtime", default=None)
+# Base URL of the request being served, for absolute links when
+# settings.backend_url is not configured
+_request_base_url: ContextVar[str] = ContextVar("request_base_url", default="")
+
+class RuntimeProxy:
+    """Stands for one attribute of the active Runtime."""
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def _target(self):
+        runtime = _active_runtime.get()
+        if runtime is None:
+            raise RuntimeError(f"`{self._name}` used outside of an app built by create_app()")
+        return getattr(runtime, self._name)
+
+    def __getattr__(self, attr: str):
+        return getattr(self._target(), attr)
+
+    def __getitem__(self, key):
+        return self._target()[key]
+
+settings = RuntimeProxy("settings")
+client = RuntimeProxy("client")
+db = RuntimeProxy("db")
+load_shedder = RuntimeProxy("load_shedder")
+rate_limit_backend = RuntimeProxy("rate_limit_backend")
+job_queue = RuntimeProxy("job_queue")
+product_reads = RuntimeProxy("product_reads")
+image_cache = RuntimeProxy("image_cache")
+image_renders = RuntimeProxy("image_renders")
+facets_snapshot = RuntimeProxy("facets_snapshot")
 
 # Security
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
-JWT_SECRET = os.environ.get('JWT_SECRET', 'your-secret-key-change-in-production')
+optional_security = HTTPBearer(auto_error=False)
 JWT_ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7  # 7 days
 
+# Guest carts: the token is valid for 30 days, the stored cart expires after
+# 7 days without activity (TTL index on `expires_at`).
+GUEST_CART_TOKEN_EXPIRE_DAYS = 30
+GUEST_CART_TTL_DAYS = 7
+GUEST_CART_HEADER = "X-Guest-Cart"
+
+@lru_cache(maxsize=None)
+def password_context():
+    from passlib.context import CryptContext
+    return CryptContext(schemes=["bcrypt"], deprecated="auto")
+
 # Stripe
-STRIPE_API_KEY = os.environ.get('STRIPE_API_KEY')
+def stripe_checkout_module():
+    """The payment integration is by far the slowest import, so it is loaded on first checkout."""
+    from emergentintegrations.payments.stripe import checkout
+    return checkout
 
-# Create the main app
-app = FastAPI()
 api_router = APIRouter(prefix="/api")
 
 # --- Models ---
@@ -47,10 +239,12 @@ class UserCreate(BaseModel):
     email: EmailStr
     password: str
     name: str
+    guest_cart_token: Optional[str] = None
 
 class UserLogin(BaseModel):
     email: EmailStr
     password: str
+    guest_cart_token: Optional[str] = None
 
 class User(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -76,8 +270,17 @@ class Product(BaseModel):
     image_url: str
     category: str
     stock: int
+    image_hash: Optional[str] = None
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
+    @computed_field
+    @property
+    def image_srcset(self) -> Optional[Dict[str, str]]:
+        """Resized variants per format, available once the image has been ingested."""
+        if not self.image_hash:
+            return None
+        return {fmt: image_srcset(self.image_hash, fmt) for fmt in IMAGE_FORMATS}
+
 class ProductCreate(BaseModel):
     name: str
     description: str
@@ -92,10 +295,47 @@ class CartItem(BaseModel):
     user_id: str
     product_id: str
     quantity: int
+    # Snapshot of the product when the line was last priced
+    name: Optional[str] = None
+    category: Optional[str] = None
+    unit_price_cents: int = 0
+    line_total_cents: int = 0
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
-class CartItemAdd(BaseModel):
+class ReorderRequest(BaseModel):
+    order_ids: List[str]
+
+class ReorderSkippedItem(BaseModel):
     product_id: str
+    name: str
+    reason: str  # "discontinued" or "out_of_stock"
+
+class GuestCartToken(BaseModel):
+    guest_cart_token: str
+    expires_at: datetime
+
+class CartLine(BaseModel):
+    cart_item_id: str
+    product: Product
     quantity: int
+    unit_price: float
+    line_total: float
+
+class Cart(BaseModel):
+    items: List[CartLine]
+    item_count: int
+    subtotal: float
+    subtotal_cents: int
+    currency: str = "eur"
+
+class ReorderResult(BaseModel):
+    added: int
+    skipped: List[ReorderSkippedItem]
+    cart: Cart
+
+class CartItemAdd(BaseModel):
+    product_id: str
+    quantity: int = Field(gt=0)
 
 class Order(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -123,30 +363,105 @@ class PaymentTransaction(BaseModel):
 class CheckoutRequest(BaseModel):
     origin_url: str
 
+class DailyRevenue(BaseModel):
+    day: str
+    revenue: float = 0.0
+    orders_paid: int = 0
+    units: int = 0
+
+class CategoryRevenue(BaseModel):
+    category: str
+    revenue: float
+    units: int
+
+class RevenueReport(BaseModel):
+    start: str
+    end: str
+    revenue: float
+    orders_paid: int
+    units: int
+    days: List[DailyRevenue]
+    categories: List[CategoryRevenue]
+
+class ProductSales(BaseModel):
+    product_id: str
+    name: str
+    units: int
+    revenue: float
+
+class ConversionReport(BaseModel):
+    start: str
+    end: str
+    carts_started: int
+    checkouts_started: int
+    orders_paid: int
+    cart_to_checkout_rate: float
+    checkout_to_paid_rate: float
+    cart_to_paid_rate: float
+
+class FacetValue(BaseModel):
+    value: str
+    count: int
+    in_stock: int
+
+class PriceBucket(FacetValue):
+    min: float
+    max: Optional[float] = None
+
+class CatalogFacets(BaseModel):
+    total: int
+    in_stock: int
+    categories: List[FacetValue]
+    price_buckets: List[PriceBucket]
+
+class OrderSummaryEntry(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    id: str
+    created_at: datetime
+    total: float
+    payment_status: str
+    item_count: int
+    lines: List[str]
+
+class OrderSummary(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    user_id: str
+    order_count: int = 0
+    paid_order_count: int = 0
+    lifetime_spend: float = 0.0
+    last_order_at: Optional[datetime] = None
+    orders: List[OrderSummaryEntry] = []
+    # Whether older orders can be fetched with `before`
+    has_more: bool = False
+
 # --- Helper Functions ---
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_context().verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return password_context().hash(password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
+    from jose import jwt
+    
     to_encode = data.copy()
     if expires_delta:
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, settings.jwt_secret, algorithm=JWT_ALGORITHM)
     return encoded_jwt
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)) -> User:
+    from jose import JWTError, jwt
+    
     try:
         token = credentials.credentials
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
+        payload = jwt.decode(token, settings.jwt_secret, algorithms=[JWT_ALGORITHM])
         user_id: str = payload.get("sub")
-        if user_id is None:
+        if user_id is None or payload.get("typ") == "guest_cart":
             raise HTTPException(status_code=401, detail="Invalid authentication credentials")
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid authentication credentials")
@@ -160,6 +475,1365 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
     
     return User(**user_doc)
 
+async def get_admin_user(current_user: User = Depends(get_current_user)) -> User:
+    if current_user.email.lower() not in {email.lower() for email in settings.admin_emails}:
+        raise HTTPException(status_code=403, detail="Accès réservé aux administrateurs")
+    return current_user
+
+# --- Guest carts ---
+
+# Guest cart lines live in `cart_items` like any other, owned by "guest:<id>",
+# so the pricing engine handles them unchanged.
+
+def create_guest_cart_token() -> GuestCartToken:
+    expires_at = datetime.now(timezone.utc) + timedelta(days=GUEST_CART_TOKEN_EXPIRE_DAYS)
+    token = create_access_token(
+        data={"sub": str(uuid.uuid4()), "typ": "guest_cart"},
+        expires_delta=timedelta(days=GUEST_CART_TOKEN_EXPIRE_DAYS)
+    )
+    return GuestCartToken(guest_cart_token=token, expires_at=expires_at)
+
+def guest_cart_owner(token: str) -> str:
+    from jose import JWTError, jwt
+    
+    try:
+        payload = jwt.decode(token, settings.jwt_secret, algorithms=[JWT_ALGORITHM])
+    except JWTError:
+        raise HTTPException(status_code=401, detail="Panier invité invalide ou expiré")
+    if payload.get("typ") != "guest_cart" or not payload.get("sub"):
+        raise HTTPException(status_code=401, detail="Panier invité invalide ou expiré")
+    return f"guest:{payload['sub']}"
+
+def is_guest(owner: str) -> bool:
+    return owner.startswith("guest:")
+
+async def get_cart_owner(request: Request, credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)) -> str:
+    """The signed-in user's id, or the guest cart owner from the X-Guest-Cart header."""
+    if credentials is not None:
+        return (await get_current_user(credentials)).id
+    token = request.headers.get(GUEST_CART_HEADER)
+    if token:
+        return guest_cart_owner(token)
+    raise HTTPException(status_code=401, detail="Connectez-vous ou utilisez un panier invité")
+
+async def touch_guest_cart(owner: str):
+    """Push back the expiry of a guest cart after activity."""
+    expires_at = datetime.now(timezone.utc) + timedelta(days=GUEST_CART_TTL_DAYS)
+    await db.cart_items.update_many({"user_id": owner}, {"$set": {"expires_at": expires_at}})
+    await db.carts.update_one({"user_id": owner}, {"$set": {"expires_at": expires_at}})
+
+async def merge_guest_cart(token: str, user_id: str):
+    """Fold a guest cart into the user's cart with a single bulk write, then drop the guest cart."""
+    try:
+        owner = guest_cart_owner(token)
+    except HTTPException:
+        # An expired guest cart must not make the login fail
+        return
+    guest_lines = await db.cart_items.find({"user_id": owner}, {"_id": 0}).to_list(1000)
+    if not guest_lines:
+        await db.carts.delete_one({"user_id": owner})
+        return
+
+    lookup = ProductLookup()
+    await lookup.load(line['product_id'] for line in guest_lines)
+    quantities = {line['product_id']: line['quantity'] for line in guest_lines if lookup.get(line['product_id'])}
+    await bulk_add_to_cart(user_id, quantities, lookup)
+
+    await db.cart_items.delete_many({"user_id": owner})
+    await db.carts.delete_one({"user_id": owner})
+
+# --- Cart pricing ---
+
+# Money is handled in integer cents. Products keep their euro float price, which
+# is converted once, exactly, when a cart line is priced.
+
+def to_cents(amount: float) -> int:
+    return int((Decimal(str(amount)) * 100).quantize(Decimal("1"), rounding=ROUND_HALF_UP))
+
+def from_cents(cents: int) -> float:
+    return float(Decimal(cents) / 100)
+
+def price_cart_line(product: dict, quantity: int) -> Dict[str, Any]:
+    unit_price_cents = to_cents(product['price'])
+    return {
+        "name": product['name'],
+        "category": product['category'],
+        "unit_price_cents": unit_price_cents,
+        "line_total_cents": unit_price_cents * quantity
+    }
+
+def cart_line_increment(owner: str, product: dict, quantity: int) -> tuple:
+    """Filter and update adding `quantity` of a product to a cart line, creating it if needed.
+
+    Quantity and line total move together with $inc, so concurrent adds of
+    the same product commute. The unique (user_id, product_id) index makes
+    concurrent upserts land on a single line.
+    """
+    snapshot = price_cart_line(product, quantity)
+    return {"user_id": owner, "product_id": product['id']}, {
+        "$inc": {"quantity": quantity, "line_total_cents": snapshot['line_total_cents']},
+        "$set": {
+            "name": snapshot['name'],
+            "category": snapshot['category'],
+            "unit_price_cents": snapshot['unit_price_cents'],
+            "updated_at": datetime.now(timezone.utc)
+        },
+        "$setOnInsert": {"id": str(uuid.uuid4())}
+    }
+
+async def realign_cart_lines(query: dict):
+    """Set line totals back to unit price times quantity, for lines incremented over an outdated snapshot."""
+    await db.cart_items.update_many(query, [{"$set": {"line_total_cents": {"$multiply": ["$unit_price_cents", "$quantity"]}}}])
+
+async def merge_duplicate_cart_lines():
+    """Fold lines duplicated by concurrent adds (before the unique index existed) into one line per product."""
+    duplicates = await db.cart_items.aggregate([
+        {"$group": {"_id": {"user_id": "$user_id", "product_id": "$product_id"}, "ids": {"$push": "$id"}, "quantity": {"$sum": "$quantity"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}}
+    ]).to_list(None)
+    for duplicate in duplicates:
+        keep, *drop = duplicate['ids']
+        await db.cart_items.update_one({"id": keep}, {"$set": {"quantity": duplicate['quantity']}})
+        await db.cart_items.delete_many({"id": {"$in": drop}})
+        await realign_cart_lines({"id": keep})
+        await recompute_cart(duplicate['_id']['user_id'])
+
+class ProductLookup:
+    """Per-request memo of products by id, filled with batched $in queries.
+
+    Use as a dependency (`lookup: ProductLookup = Depends(ProductLookup)`) so
+    that every order or cart line resolved during a request costs at most one
+    query per batch of new ids. Unknown ids resolve to None.
+    """
+
+    def __init__(self):
+        self._products: Dict[str, Optional[dict]] = {}
+
+    async def load(self, product_ids):
+        missing = {product_id for product_id in product_ids if product_id not in self._products}
+        if not missing:
+            return
+        products = await db.products.find({"id": {"$in": list(missing)}}, {"_id": 0}).to_list(None)
+        for product in products:
+            if isinstance(product['created_at'], str):
+                product['created_at'] = datetime.fromisoformat(product['created_at'])
+            self._products[product['id']] = product
+        for product_id in missing:
+            self._products.setdefault(product_id, None)
+
+    def get(self, product_id: str) -> Optional[dict]:
+        return self._products.get(product_id)
+
+async def bulk_add_to_cart(owner: str, quantities: Dict[str, int], lookup: ProductLookup):
+    """Add several products (already loaded in `lookup`) to a cart with one bulk write, then recompute its totals once."""
+    if not quantities:
+        return
+    operations = [
+        UpdateOne(*cart_line_increment(owner, lookup.get(product_id), quantity), upsert=True)
+        for product_id, quantity in quantities.items()
+    ]
+    await db.cart_items.bulk_write(operations, ordered=False)
+    await realign_cart_lines({"user_id": owner, "product_id": {"$in": list(quantities)}})
+    await recompute_cart(owner)
+
+async def recompute_cart(user_id: str) -> dict:
+    """Rebuild the cart totals from its lines, pricing lines that predate snapshots.
+
+    Lines whose product no longer exists are dropped.
+    """
+    lines = await db.cart_items.find({"user_id": user_id}, {"_id": 0}).to_list(1000)
+    unpriced = [line['product_id'] for line in lines if 'unit_price_cents' not in line]
+    if unpriced:
+        products = await db.products.find({"id": {"$in": unpriced}}, {"_id": 0}).to_list(None)
+        products = {p['id']: p for p in products}
+        kept, stale, updates = [], [], []
+        for line in lines:
+            if 'unit_price_cents' not in line:
+                product = products.get(line['product_id'])
+                if product is None:
+                    stale.append(line['id'])
+                    continue
+                snapshot = price_cart_line(product, line['quantity'])
+                line.update(snapshot)
+                updates.append(UpdateOne({"id": line['id']}, {"$set": snapshot}))
+            kept.append(line)
+        if stale:
+            await db.cart_items.delete_many({"id": {"$in": stale}})
+        if updates:
+            await db.cart_items.bulk_write(updates, ordered=False)
+        lines = kept
+
+    cart = {
+        "user_id": user_id,
+        "subtotal_cents": sum(line['line_total_cents'] for line in lines),
+        "item_count": sum(line['quantity'] for line in lines),
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+    if is_guest(user_id):
+        cart['expires_at'] = datetime.now(timezone.utc) + timedelta(days=GUEST_CART_TTL_DAYS)
+    await db.carts.update_one({"user_id": user_id}, {"$set": cart}, upsert=True)
+    return cart
+
+async def apply_cart_delta(user_id: str, subtotal_cents: int, item_count: int):
+    """Adjust the cached cart totals after a line changed."""
+    result = await db.carts.update_one(
+        {"user_id": user_id},
+        {
+            "$inc": {"subtotal_cents": subtotal_cents, "item_count": item_count},
+            "$set": {"updated_at": datetime.now(timezone.utc).isoformat()}
+        }
+    )
+    if result.matched_count == 0:
+        await recompute_cart(user_id)
+
+async def empty_cart(user_id: str):
+    await db.cart_items.delete_many({"user_id": user_id})
+    await db.carts.update_one(
+        {"user_id": user_id},
+        {"$set": {"subtotal_cents": 0, "item_count": 0, "updated_at": datetime.now(timezone.utc).isoformat()}}
+    )
+
+async def reprice_product_in_carts(product: dict):
+    """Refresh the snapshot of every cart line referencing a product and shift the affected cart totals."""
+    lines = await db.cart_items.find(
+        {"product_id": product['id']}, {"_id": 0, "id": 1, "user_id": 1, "quantity": 1, "line_total_cents": 1}
+    ).to_list(None)
+    if not lines:
+        return
+
+    line_updates = []
+    deltas: Dict[str, int] = defaultdict(int)
+    for line in lines:
+        snapshot = price_cart_line(product, line['quantity'])
+        line_updates.append(UpdateOne({"id": line['id']}, {"$set": snapshot}))
+        deltas[line['user_id']] += snapshot['line_total_cents'] - line.get('line_total_cents', 0)
+
+    await db.cart_items.bulk_write(line_updates, ordered=False)
+    cart_updates = [
+        UpdateOne({"user_id": user_id}, {"$inc": {"subtotal_cents": delta}})
+        for user_id, delta in deltas.items() if delta
+    ]
+    if cart_updates:
+        await db.carts.bulk_write(cart_updates, ordered=False)
+
+async def remove_product_from_carts(product_id: str):
+    lines = await db.cart_items.find(
+        {"product_id": product_id}, {"_id": 0, "user_id": 1, "quantity": 1, "line_total_cents": 1}
+    ).to_list(None)
+    if not lines:
+        return
+    await db.cart_items.delete_many({"product_id": product_id})
+    await db.carts.bulk_write([
+        UpdateOne(
+            {"user_id": line['user_id']},
+            {"$inc": {"subtotal_cents": -line.get('line_total_cents', 0), "item_count": -line['quantity']}}
+        )
+        for line in lines
+    ], ordered=False)
+
+# --- Order summaries (read model) ---
+
+# Number of compact order entries kept on the summary document; older orders
+# are paged from `orders` (GET /orders/summary?before=...).
+ORDER_SUMMARY_MAX_ENTRIES = 50
+ORDER_HISTORY_PAGE_SIZE = ORDER_SUMMARY_MAX_ENTRIES
+
+def order_summary_entry(order_doc: dict) -> dict:
+    created_at = order_doc['created_at']
+    if isinstance(created_at, datetime):
+        created_at = created_at.isoformat()
+    return {
+        "id": order_doc['id'],
+        "created_at": created_at,
+        "total": order_doc['total'],
+        "payment_status": order_doc['payment_status'],
+        "item_count": sum(item['quantity'] for item in order_doc['items']),
+        "lines": [f"{item['name']} x {item['quantity']}" for item in order_doc['items']]
+    }
+
+async def record_order_created(order_doc: dict):
+    entry = order_summary_entry(order_doc)
+    result = await db.order_summaries.update_one(
+        {"user_id": order_doc['user_id']},
+        {
+            "$inc": {"order_count": 1},
+            "$max": {"last_order_at": entry['created_at']},
+            "$push": {"orders": {
+                "$each": [entry],
+                "$sort": {"created_at": -1},
+                "$slice": ORDER_SUMMARY_MAX_ENTRIES
+            }}
+        }
+    )
+    if result.matched_count == 0:
+        # First order seen by the read model: build it from `orders` so that
+        # history predating the summary collection is counted too.
+        await rebuild_order_summary(order_doc['user_id'])
+
+async def record_order_paid(order_doc: dict):
+    await db.order_summaries.update_one(
+        {"user_id": order_doc['user_id']},
+        {"$inc": {"paid_order_count": 1, "lifetime_spend": order_doc['total']}}
+    )
+    await db.order_summaries.update_one(
+        {"user_id": order_doc['user_id'], "orders.id": order_doc['id']},
+        {"$set": {"orders.$.payment_status": "paid"}}
+    )
+
+async def order_history_page(user_id: str, before: datetime) -> tuple:
+    """Summary entries of the orders placed before `before`, newest first, and whether more follow.
+
+    Backed by the (user_id, created_at) index and projected to the fields an
+    entry needs.
+    """
+    if before.tzinfo is None:
+        before = before.replace(tzinfo=timezone.utc)
+    orders = await db.orders.find(
+        {"user_id": user_id, "created_at": {"$lt": before.astimezone(timezone.utc).isoformat()}},
+        {"_id": 0, "id": 1, "created_at": 1, "total": 1, "payment_status": 1, "items.name": 1, "items.quantity": 1}
+    ).sort("created_at", -1).limit(ORDER_HISTORY_PAGE_SIZE + 1).to_list(None)
+    return [order_summary_entry(o) for o in orders[:ORDER_HISTORY_PAGE_SIZE]], len(orders) > ORDER_HISTORY_PAGE_SIZE
+
+async def rebuild_order_summary(user_id: str) -> dict:
+    """Build the summary document from `orders` for users who ordered before the read model existed."""
+    orders = await db.orders.find({"user_id": user_id}, {"_id": 0}).sort("created_at", -1).to_list(None)
+    paid = [o for o in orders if o['payment_status'] == 'paid']
+    summary = {
+        "user_id": user_id,
+        "order_count": len(orders),
+        "paid_order_count": len(paid),
+        "lifetime_spend": sum(o['total'] for o in paid),
+        "last_order_at": orders[0]['created_at'] if orders else None,
+        "orders": [order_summary_entry(o) for o in orders[:ORDER_SUMMARY_MAX_ENTRIES]]
+    }
+    await db.order_summaries.update_one({"user_id": user_id}, {"$set": summary}, upsert=True)
+    return summary
+
+# Side effects of a payment, each recorded in the order's `paid_effects` once
+# applied so that a retried job resumes with the ones that did not complete
+PAID_ORDER_EFFECTS = ("summary", "analytics")
+
+async def mark_order_paid(order_id: str) -> Optional[dict]:
+    """Flip an order to paid and apply each side effect at most once. Returns None for an unknown order."""
+    paid_at = datetime.now(timezone.utc)
+    order = await db.orders.find_one_and_update(
+        {"id": order_id, "payment_status": {"$ne": "paid"}},
+        {"$set": {"payment_status": "paid", "paid_at": paid_at.isoformat(), "paid_effects": []}},
+        projection={"_id": 0},
+        return_document=ReturnDocument.AFTER
+    )
+    if order is None:
+        # Already flipped by an earlier attempt, which may have failed halfway
+        order = await db.orders.find_one({"id": order_id}, {"_id": 0})
+        if order is None:
+            return None
+    # Orders paid before the markers existed had all their effects applied
+    done = set(order.get('paid_effects', PAID_ORDER_EFFECTS))
+
+    async def applied(effect: str):
+        await db.orders.update_one({"id": order_id}, {"$addToSet": {"paid_effects": effect}})
+
+    if "summary" not in done:
+        await record_order_paid(order)
+        await applied("summary")
+    if "analytics" not in done:
+        await record_sale(order, day=order.get('paid_at', paid_at.isoformat())[:10])
+        await applied("analytics")
+    return order
+
+# --- Analytics rollups ---
+
+# Rollups are keyed by UTC day ("YYYY-MM-DD") and only ever receive $inc
+# updates, so the admin reports read a handful of small documents instead of
+# aggregating `orders`.
+
+def today_key() -> str:
+    return datetime.now(timezone.utc).date().isoformat()
+
+async def record_funnel_event(field: str):
+    await db.analytics_daily.update_one({"day": today_key()}, {"$inc": {field: 1}}, upsert=True)
+
+async def record_sale(order_doc: dict, day: Optional[str] = None):
+    day = day or today_key()
+    items = order_doc['items']
+    units = sum(item['quantity'] for item in items)
+    await db.analytics_daily.update_one(
+        {"day": day},
+        {"$inc": {"revenue": order_doc['total'], "orders_paid": 1, "units": units}},
+        upsert=True
+    )
+
+    # Orders created before lines carried their category need one batched lookup.
+    missing = [item['product_id'] for item in items if not item.get('category')]
+    categories = {}
+    if missing:
+        products = await db.products.find(
+            {"id": {"$in": missing}}, {"_id": 0, "id": 1, "category": 1}
+        ).to_list(None)
+        categories = {p['id']: p['category'] for p in products}
+
+    by_category: Dict[str, Dict[str, Any]] = {}
+    product_updates = []
+    for item in items:
+        category = item.get('category') or categories.get(item['product_id'], "Non classé")
+        bucket = by_category.setdefault(category, {"revenue": 0.0, "units": 0})
+        bucket['revenue'] += item['subtotal']
+        bucket['units'] += item['quantity']
+        product_updates.append(UpdateOne(
+            {"day": day, "product_id": item['product_id']},
+            {
+                "$inc": {"units": item['quantity'], "revenue": item['subtotal']},
+                "$set": {"name": item['name']}
+            },
+            upsert=True
+        ))
+
+    if product_updates:
+        await db.analytics_product_daily.bulk_write(product_updates, ordered=False)
+        await db.analytics_category_daily.bulk_write([
+            UpdateOne({"day": day, "category": category}, {"$inc": bucket}, upsert=True)
+            for category, bucket in by_category.items()
+        ], ordered=False)
+
+def analytics_range(start: Optional[str], end: Optional[str]) -> tuple:
+    end = end or today_key()
+    start = start or end
+    try:
+        # Normalized, since days are compared as strings ("2026-3-1" parses too)
+        start = datetime.strptime(start, "%Y-%m-%d").strftime("%Y-%m-%d")
+        end = datetime.strptime(end, "%Y-%m-%d").strftime("%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Dates attendues au format AAAA-MM-JJ")
+    if start > end:
+        raise HTTPException(status_code=400, detail="La date de début doit précéder la date de fin")
+    return start, end
+
+# --- Rate limiting ---
+
+class RateBudget(BaseModel):
+    capacity: float
+    refill_per_second: float
+
+# Token buckets per route. Each route is limited both per client IP and per
+# user (account id, or the client IP and submitted email for login, so that
+# nobody can lock an account out from another address).
+ROUTE_BUDGETS: Dict[str, Dict[str, RateBudget]] = {
+    "login": {
+        "ip": RateBudget(capacity=20, refill_per_second=20 / 60),
+        "user": RateBudget(capacity=5, refill_per_second=5 / 60),
+    },
+    "register": {
+        "ip": RateBudget(capacity=5, refill_per_second=5 / 600),
+    },
+    "checkout_session": {
+        "ip": RateBudget(capacity=10, refill_per_second=10 / 60),
+        "user": RateBudget(capacity=5, refill_per_second=5 / 60),
+    },
+    "checkout_status": {
+        "ip": RateBudget(capacity=60, refill_per_second=1),
+        "user": RateBudget(capacity=30, refill_per_second=0.5),
+    },
+    "order_export": {
+        "ip": RateBudget(capacity=10, refill_per_second=10 / 60),
+        "user": RateBudget(capacity=5, refill_per_second=5 / 60),
+    },
+}
+
+class InMemoryRateLimitBackend:
+    """Per-process buckets; enough for a single worker."""
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()
+
+    async def consume(self, key: str, budget: RateBudget) -> float:
+        """Take one token. Returns 0 when allowed, otherwise the seconds until a token is available."""
+        now = time.monotonic()
+        tokens, updated = self._buckets.pop(key, (budget.capacity, now))
+        tokens = min(budget.capacity, tokens + (now - updated) * budget.refill_per_second)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        return 0.0 if allowed else (1 - tokens) / budget.refill_per_second
+
+class MongoRateLimitBackend:
+    """Buckets shared by every worker, refilled atomically with a pipeline update."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    async def consume(self, key: str, budget: RateBudget) -> float:
+        now = datetime.now(timezone.utc)
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        bucket = await self.collection.find_one_and_update(
+            {"key": key},
+            [
+                {"$set": {"tokens": {"$min": [
+                    budget.capacity,
+                    {"$add": [{"$ifNull": ["$tokens", budget.capacity]}, {"$multiply": [elapsed, budget.refill_per_second]}]}
+                ]}}},
+                {"$set": {"allowed": {"$gte": ["$tokens", 1]}, "updated_at": now}},
+                {"$set": {"tokens": {"$cond": ["$allowed", {"$subtract": ["$tokens", 1]}, "$tokens"]}}},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+            projection={"_id": 0, "tokens": 1, "allowed": 1}
+        )
+        return 0.0 if bucket['allowed'] else (1 - bucket['tokens']) / budget.refill_per_second
+
+def client_ip(request: Request) -> str:
+    if settings.rate_limit_trust_forwarded:
+        # The proxy appends the address it saw, so the last hop is the one we can trust.
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[-1].strip()
+    return request.client.host if request.client else "unknown"
+
+async def enforce_rate_limit(request: Request, route: str, user_key: Optional[str] = None):
+    """Shed load and apply the route's token buckets. Only expensive routes call this, so catalog reads are never throttled."""
+    if load_shedder.overloaded():
+        raise HTTPException(
+            status_code=503,
+            detail="Service momentanément surchargé, veuillez réessayer",
+            headers={"Retry-After": "1"}
+        )
+
+    budgets = ROUTE_BUDGETS[route]
+    keys = [("ip", client_ip(request))]
+    if user_key and "user" in budgets:
+        keys.append(("user", user_key.lower()))
+
+    retry_after = 0.0
+    for scope, value in keys:
+        retry_after = max(retry_after, await rate_limit_backend.consume(f"{route}:{scope}:{value}", budgets[scope]))
+    if retry_after > 0:
+        raise HTTPException(
+            status_code=429,
+            detail="Trop de requêtes, veuillez réessayer plus tard",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+        )
+
+# --- Background jobs ---
+
+class JobQueue:
+    """Durable Mongo-backed queue drained by a pool of asyncio workers.
+
+    Jobs are claimed atomically with a lease (`locked_until`), renewed while the
+    handler runs, so a crashed worker's job is picked up again once the lease
+    expires while a long one is never claimed twice. Failures are retried
+    with exponential backoff; jobs that exhaust `max_attempts` are moved to the
+    dead-letter collection. Completed jobs are kept until their TTL expires so
+    `dedup_key` keeps rejecting duplicates for that window.
+    """
+
+    def __init__(self, collection, dead_letter, handlers: Dict[str, Callable[[Dict[str, Any]], Awaitable[None]]],
+                 workers: int = 2, poll_interval: float = 1.0, lease_seconds: int = 60,
+                 max_attempts: int = 5, backoff_seconds: float = 2.0):
+        self.collection = collection
+        self.dead_letter = dead_letter
+        self.handlers = handlers
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+
+    async def enqueue(self, job_type: str, payload: Dict[str, Any], dedup_key: Optional[str] = None,
+                      run_at: Optional[datetime] = None) -> bool:
+        """Queue a job, optionally not before `run_at`. Returns False when a job with the same dedup_key already exists."""
+        now = datetime.now(timezone.utc)
+        job = {
+            "id": str(uuid.uuid4()),
+            "type": job_type,
+            "payload": payload,
+            "status": "queued",
+            "attempts": 0,
+            "run_at": run_at or now,
+            "locked_until": None,
+            "last_error": None,
+            "created_at": now
+        }
+        if dedup_key:
+            job["dedup_key"] = dedup_key
+        try:
+            await self.collection.insert_one(job)
+        except DuplicateKeyError:
+            return False
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return True
+
+    async def _claim(self) -> Optional[dict]:
+        now = datetime.now(timezone.utc)
+        return await self.collection.find_one_and_update(
+            {"$or": [
+                {"status": "queued", "run_at": {"$lte": now}},
+                {"status": "running", "locked_until": {"$lte": now}}
+            ]},
+            {
+                "$set": {"status": "running", "locked_until": now + timedelta(seconds=self.lease_seconds)},
+                "$inc": {"attempts": 1}
+            },
+            sort=[("run_at", 1)],
+            return_document=ReturnDocument.AFTER,
+            projection={"_id": 0}
+        )
+
+    async def _renew_lease(self, job: dict):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            # `attempts` identifies this claim; a job taken over by another worker is left alone
+            await self.collection.update_one(
+                {"id": job['id'], "status": "running", "attempts": job['attempts']},
+                {"$set": {"locked_until": datetime.now(timezone.utc) + timedelta(seconds=self.lease_seconds)}}
+            )
+
+    async def _process(self, job: dict):
+        heartbeat = asyncio.get_running_loop().create_task(self._renew_lease(job))
+        try:
+            try:
+                await self.handlers[job['type']](job['payload'])
+            finally:
+                heartbeat.cancel()
+        except Exception as e:
+            logger.exception(f"Job {job['type']} {job['id']} failed (attempt {job['attempts']})")
+            if job['attempts'] >= self.max_attempts:
+                job.update(status="dead", last_error=str(e), failed_at=datetime.now(timezone.utc))
+                await self.dead_letter.insert_one(job)
+                await self.collection.delete_one({"id": job['id']})
+            else:
+                delay = self.backoff_seconds * 2 ** (job['attempts'] - 1)
+                await self.collection.update_one({"id": job['id']}, {"$set": {
+                    "status": "queued",
+                    "run_at": datetime.now(timezone.utc) + timedelta(seconds=delay),
+                    "locked_until": None,
+                    "last_error": str(e)
+                }})
+        else:
+            await self.collection.update_one({"id": job['id']}, {"$set": {
+                "status": "done",
+                "locked_until": None,
+                "completed_at": datetime.now(timezone.utc)
+            }})
+
+    async def _worker(self):
+        while True:
+            try:
+                job = await self._claim()
+            except Exception:
+                logger.exception("Job queue poll failed")
+                job = None
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._process(job)
+
+    def start(self):
+        if not self._tasks:
+            self._wakeup = asyncio.Event()
+            self._tasks = [asyncio.get_running_loop().create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+JOB_HANDLERS: Dict[str, Callable[[Dict[str, Any]], Awaitable[None]]] = {}
+
+def job_handler(job_type: str):
+    def register(func):
+        JOB_HANDLERS[job_type] = func
+        return func
+    return register
+
+@job_handler("order_paid")
+async def handle_order_paid(payload: Dict[str, Any]):
+    order = await mark_order_paid(payload['order_id'])
+    if order:
+        # Idempotent, so it runs on every attempt
+        await empty_cart(order['user_id'])
+
+async def enqueue_order_paid(order_id: str):
+    await job_queue.enqueue("order_paid", {"order_id": order_id}, dedup_key=f"order_paid:{order_id}")
+
+# --- Request coalescing ---
+
+class SingleFlight:
+    """Shares one in-flight call between concurrent callers asking for the same key."""
+
+    def __init__(self, max_waiters: int = 1000):
+        self.max_waiters = max_waiters
+        self._calls: Dict[Any, List[Any]] = {}  # key -> [task, waiter count]
+        self.requests = 0
+        self.executions = 0
+        self.rejected = 0
+
+    async def do(self, key: Any, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.requests += 1
+        call = self._calls.get(key)
+        if call is None:
+            self.executions += 1
+            # Run as its own task so a disconnecting leader does not cancel the followers.
+            task = asyncio.ensure_future(fn())
+            call = self._calls[key] = [task, 0]
+            task.add_done_callback(lambda _: self._forget(key, task))
+        elif call[1] >= self.max_waiters:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Service momentanément surchargé, veuillez réessayer",
+                headers={"Retry-After": "1"}
+            )
+
+        call[1] += 1
+        try:
+            return await asyncio.shield(call[0])
+        finally:
+            call[1] -= 1
+
+    def _forget(self, key: Any, task: asyncio.Task):
+        call = self._calls.get(key)
+        if call is not None and call[0] is task:
+            del self._calls[key]
+
+    def stats(self) -> Dict[str, Any]:
+        coalesced = self.requests - self.executions - self.rejected
+        return {
+            "requests": self.requests,
+            "executions": self.executions,
+            "coalesced": coalesced,
+            "rejected": self.rejected,
+            "coalescing_ratio": round(coalesced / self.requests, 4) if self.requests else 0.0,
+            "in_flight": len(self._calls)
+        }
+
+# --- Product images ---
+
+IMAGE_WIDTHS = (320, 640, 960, 1280)
+IMAGE_FORMATS = {"webp": "image/webp", "jpeg": "image/jpeg"}
+MAX_SOURCE_IMAGE_BYTES = 20 * 1024 * 1024
+MAX_SOURCE_IMAGE_REDIRECTS = 3
+IMAGE_HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+def image_variant_url(image_hash: str, width: int, fmt: str) -> str:
+    # Absolute: the frontend is served from another origin
+    base_url = settings.backend_url or _request_base_url.get()
+    return f"{base_url.rstrip('/')}/api/images/{image_hash}/{width}.{fmt}"
+
+def image_srcset(image_hash: str, fmt: str) -> str:
+    return ", ".join(f"{image_variant_url(image_hash, width, fmt)} {width}w" for width in IMAGE_WIDTHS)
+
+class ImageCache:
+    """Content-addressed image store on disk.
+
+    Originals are kept under their sha256. Resized variants are rendered on
+    demand and evicted least-recently-used once they exceed `max_bytes`.
+    Methods do blocking file and Pillow work and are meant for the threadpool.
+    """
+
+    def __init__(self, root: Path, max_bytes: int):
+        self.originals = root / 'originals'
+        self.variants = root / 'variants'
+        self.originals.mkdir(parents=True, exist_ok=True)
+        self.variants.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._used: Optional[int] = None
+
+    def original_path(self, image_hash: str) -> Path:
+        return self.originals / image_hash
+
+    def variant_path(self, image_hash: str, width: int, fmt: str) -> Path:
+        return self.variants / f"{image_hash}-{width}.{fmt}"
+
+    @staticmethod
+    def _write(path: Path, data: bytes):
+        tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def store_original(self, data: bytes) -> str:
+        """Validate and store source image bytes. Returns their content hash."""
+        from PIL import Image, UnidentifiedImageError
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                img.verify()
+        except (UnidentifiedImageError, OSError):
+            raise HTTPException(status_code=400, detail="Fichier image invalide")
+
+        image_hash = hashlib.sha256(data).hexdigest()
+        path = self.original_path(image_hash)
+        if not path.exists():
+            self._write(path, data)
+        return image_hash
+
+    def render_variant(self, image_hash: str, width: int, fmt: str) -> Path:
+        from PIL import Image, ImageOps
+        path = self.variant_path(image_hash, width, fmt)
+        if path.exists():
+            os.utime(path)
+            return path
+
+        with Image.open(self.original_path(image_hash)) as img:
+            img = ImageOps.exif_transpose(img)
+            # Width-bounded and never upscaled; thumbnail keeps the aspect ratio
+            img.thumbnail((width, img.height))
+            if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            buffer = io.BytesIO()
+            img.save(buffer, format=fmt.upper(), quality=80)
+
+        data = buffer.getvalue()
+        self._write(path, data)
+        self._account(len(data), keep=path)
+        return path
+
+    def _account(self, size: int, keep: Path):
+        with self._lock:
+            if self._used is None:
+                self._used = sum(p.stat().st_size for p in self.variants.iterdir())
+            else:
+                self._used += size
+            if self._used <= self.max_bytes:
+                return
+            # Evict down to 90% so that we do not rescan on every render
+            target = self.max_bytes * 0.9
+            for path in sorted(self.variants.iterdir(), key=lambda p: p.stat().st_mtime):
+                if self._used <= target:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    size = path.stat().st_size
+                    path.unlink()
+                except FileNotFoundError:
+                    continue
+                self._used -= size
+
+async def resolve_public_address(url) -> str:
+    """Resolve the host of an http(s) URL, refusing it unless every address is public. Returns the address to connect to."""
+    if url.scheme not in ("http", "https") or not url.host:
+        raise HTTPException(status_code=400, detail="URL d'image invalide")
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(
+            url.host, url.port or (443 if url.scheme == "https" else 80), type=socket.SOCK_STREAM
+        )
+    except socket.gaierror:
+        raise HTTPException(status_code=502, detail="Image source inaccessible")
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split("%")[0])
+        if not address.is_global:
+            raise HTTPException(status_code=400, detail="URL d'image non autorisée")
+    return infos[0][4][0].split("%")[0]
+
+async def fetch_source_image(url: str) -> bytes:
+    """Download a source image, checking every redirect target and stopping at MAX_SOURCE_IMAGE_BYTES."""
+    import httpx
+    try:
+        target = httpx.URL(url)
+    except httpx.InvalidURL:
+        raise HTTPException(status_code=400, detail="URL d'image invalide")
+    try:
+        async with httpx.AsyncClient(timeout=10, follow_redirects=False) as http:
+            for _ in range(MAX_SOURCE_IMAGE_REDIRECTS + 1):
+                address = await resolve_public_address(target)
+                # Connect to the address that was checked, not a second
+                # resolution (DNS rebinding); Host and SNI keep the real name
+                request = http.build_request(
+                    "GET",
+                    target.copy_with(host=address),
+                    headers={"Host": target.netloc.decode("ascii")},
+                    extensions={"sni_hostname": target.host}
+                )
+                response = await http.send(request, stream=True)
+                try:
+                    if response.is_redirect:
+                        target = target.join(response.headers["location"])
+                        continue
+                    response.raise_for_status()
+                    chunks, size = [], 0
+                    async for chunk in response.aiter_bytes():
+                        size += len(chunk)
+                        if size > MAX_SOURCE_IMAGE_BYTES:
+                            raise HTTPException(status_code=413, detail="Image trop volumineuse")
+                        chunks.append(chunk)
+                    return b"".join(chunks)
+                finally:
+                    await response.aclose()
+    except httpx.HTTPError as e:
+        logger.warning(f"Fetching image {url} failed: {e}")
+        raise HTTPException(status_code=502, detail="Image source inaccessible")
+    logger.warning(f"Fetching image {url} failed: too many redirects")
+    raise HTTPException(status_code=502, detail="Image source inaccessible")
+
+async def ingest_image(data: bytes, source_url: Optional[str] = None) -> str:
+    image_hash = await run_in_threadpool(image_cache.store_original, data)
+    update: Dict[str, Any] = {"$setOnInsert": {"created_at": datetime.now(timezone.utc).isoformat()}}
+    if source_url:
+        update["$set"] = {"source_url": source_url}
+    await db.images.update_one({"hash": image_hash}, update, upsert=True)
+    return image_hash
+
+async def ingest_image_url(url: str) -> str:
+    """Fetch a remote image once; later calls for the same URL reuse the stored original."""
+    known = await db.images.find_one({"source_url": url}, {"_id": 0, "hash": 1})
+    if known and image_cache.original_path(known['hash']).exists():
+        return known['hash']
+    return await ingest_image(await fetch_source_image(url), source_url=url)
+
+@job_handler("ingest_product_image")
+async def handle_ingest_product_image(payload: Dict[str, Any]):
+    product = await db.products.find_one({"id": payload['product_id']}, {"_id": 0, "image_url": 1})
+    if not product or not product.get('image_url'):
+        return
+    image_hash = await ingest_image_url(product['image_url'])
+    # Skip if the product was given another image in the meantime
+    await db.products.update_one(
+        {"id": payload['product_id'], "image_url": product['image_url']},
+        {"$set": {"image_hash": image_hash}}
+    )
+
+async def enqueue_product_image(product_id: str, image_url: str):
+    await job_queue.enqueue(
+        "ingest_product_image",
+        {"product_id": product_id},
+        dedup_key=f"ingest_product_image:{product_id}:{hashlib.sha256(image_url.encode()).hexdigest()}"
+    )
+
+def ranged_file_response(request: Request, path: Path, media_type: str, headers: Dict[str, str]) -> Response:
+    """Serve a file honouring a single `Range: bytes=` request."""
+    size = path.stat().st_size
+    headers = {**headers, "Accept-Ranges": "bytes"}
+    match = re.fullmatch(r"bytes=(\d*)-(\d*)", request.headers.get("range", "").strip())
+    if not match or not any(match.groups()):
+        return FileResponse(path, media_type=media_type, headers=headers)
+
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(0, size - int(last)), size - 1
+    if start > end or start >= size:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    with open(path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start + 1)
+    return Response(
+        data,
+        status_code=206,
+        media_type=media_type,
+        headers={**headers, "Content-Range": f"bytes {start}-{end}/{size}"}
+    )
+
+# --- Data retention ---
+
+class RetentionPolicy(BaseModel):
+    collection: str
+    time_field: str
+    # orders and payment_transactions store ISO strings, which compare in
+    # time order; only BSON dates can back a TTL index
+    iso_strings: bool
+    query: Dict[str, Any]
+    # Same selection as `query`, in the subset of operators MongoDB accepts
+    # in a partial index filter; None when the collection cannot use a TTL
+    ttl_query: Optional[Dict[str, Any]] = None
+    # When set, documents expire together per `user_id`, aged by the owner's
+    # document in this collection (`query` and `time_field` apply to it)
+    owner_collection: Optional[str] = None
+
+RETENTION_POLICIES = [
+    # A cart is abandoned once the cart as a whole has been idle, so its
+    # lines go together; a per-line TTL index cannot express that. Guest
+    # carts expire through their own TTL index on `expires_at`.
+    RetentionPolicy(collection="cart_items", owner_collection="carts", time_field="updated_at", iso_strings=True,
+                    query={"expires_at": {"$exists": False}}),
+    RetentionPolicy(collection="orders", time_field="created_at", iso_strings=True,
+                    query={"payment_status": {"$ne": "paid"}}),
+    RetentionPolicy(collection="payment_transactions", time_field="created_at", iso_strings=True,
+                    query={"payment_status": {"$ne": "paid"}}),
+]
+
+def retention_ttl_index_name(policy: RetentionPolicy) -> str:
+    return f"retention_{policy.time_field}_ttl"
+
+def uses_ttl_index(policy: RetentionPolicy) -> bool:
+    """Whether MongoDB purges this collection itself, so archival must leave it alone."""
+    return (policy.collection in settings.retention_ttl_collections
+            and not policy.iso_strings and policy.ttl_query is not None)
+
+async def ensure_retention_ttl_indexes():
+    """Create, retune or drop the TTL indexes of policies configured in retention_ttl_collections."""
+    for policy in RETENTION_POLICIES:
+        collection = db[policy.collection]
+        name = retention_ttl_index_name(policy)
+        days = settings.retention_days.get(policy.collection, 0)
+        if not uses_ttl_index(policy) or not days:
+            if policy.collection in settings.retention_ttl_collections:
+                logger.warning(f"{policy.collection} cannot use a TTL index; archiving instead")
+            try:
+                await collection.drop_index(name)
+            except OperationFailure:
+                pass
+            continue
+        try:
+            await collection.create_index(
+                policy.time_field, name=name, expireAfterSeconds=days * 86400, partialFilterExpression=policy.ttl_query
+            )
+        except OperationFailure as e:
+            if e.code != 85:  # IndexOptionsConflict
+                raise
+            # Same index with another expiry: adjust it in place
+            await db.command("collMod", policy.collection, index={"name": name, "expireAfterSeconds": days * 86400})
+
+class ArchiveWriter:
+    """Appends archived documents to a gzipped NDJSON file, one file per collection and run."""
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self._file = gzip.open(path, "at", encoding="utf-8")
+
+    def write(self, docs: List[dict]):
+        for doc in docs:
+            self._file.write(json_util.dumps(doc, json_options=json_util.RELAXED_JSON_OPTIONS))
+            self._file.write("\n")
+        # Flushed before the batch is deleted from Mongo
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+async def archive_collection(policy: RetentionPolicy, run_id: str) -> Dict[str, Any]:
+    days = settings.retention_days.get(policy.collection, 0)
+    report = {"collection": policy.collection, "archived": 0, "bytes": 0, "destination": None}
+    if not days or uses_ttl_index(policy):
+        return report
+
+    collection = db[policy.collection]
+    source = db[policy.owner_collection] if policy.owner_collection else collection
+    now = datetime.now(timezone.utc)
+    cutoff = now - timedelta(days=days)
+    # Documents written before the field existed start aging now
+    await source.update_many(
+        {policy.time_field: {"$exists": False}},
+        {"$set": {policy.time_field: now.isoformat() if policy.iso_strings else now}}
+    )
+    query = {**policy.query, policy.time_field: {"$lt": cutoff.isoformat() if policy.iso_strings else cutoff}}
+
+    writer = None
+    if settings.archive_target == 'collection':
+        report['destination'] = f"archive_{policy.collection}"
+    else:
+        writer = ArchiveWriter(Path(settings.archive_dir) / policy.collection / f"{run_id}.ndjson.gz")
+        report['destination'] = str(writer.path)
+
+    last_id = None
+    try:
+        while True:
+            batch_query = query if last_id is None else {**query, "_id": {"$gt": last_id}}
+            expired = await source.find(batch_query).sort("_id", 1).limit(settings.archive_batch_size).to_list(None)
+            if not expired:
+                break
+            last_id = expired[-1]['_id']
+            docs = expired
+            if policy.owner_collection:
+                docs = await collection.find({"user_id": {"$in": [owner['user_id'] for owner in expired]}}).to_list(None)
+
+            if writer is not None:
+                await run_in_threadpool(writer.write, docs)
+            elif docs:
+                try:
+                    await db[report['destination']].insert_many(docs, ordered=False)
+                except BulkWriteError as e:
+                    # Duplicate keys were already copied by an interrupted
+                    # run; anything else must keep the batch in place
+                    if any(error['code'] != 11000 for error in e.details.get('writeErrors', [])) \
+                            or e.details.get('writeConcernErrors'):
+                        raise
+
+            await collection.delete_many({"_id": {"$in": [doc['_id'] for doc in docs]}})
+            if policy.owner_collection:
+                # A line added meanwhile stays; its cart totals are rebuilt on next read
+                await source.delete_many({"_id": {"$in": [owner['_id'] for owner in expired]}})
+            elif policy.collection == "orders":
+                # Archived orders must leave the account page's read model too
+                for user_id in {doc['user_id'] for doc in docs}:
+                    await rebuild_order_summary(user_id)
+
+            report['archived'] += len(docs)
+            report['bytes'] += sum(len(bson_encode(doc)) for doc in docs)
+            # Throttle so archival never competes with live traffic
+            await asyncio.sleep(settings.archive_pause_ms / 1000)
+    finally:
+        if writer is not None:
+            await run_in_threadpool(writer.close)
+            if report['archived'] == 0:
+                writer.path.unlink(missing_ok=True)
+                report['destination'] = None
+    return report
+
+async def run_archival() -> Dict[str, Any]:
+    started_at = datetime.now(timezone.utc)
+    run_id = started_at.strftime("%Y%m%dT%H%M%SZ")
+    reports = [await archive_collection(policy, run_id) for policy in RETENTION_POLICIES]
+    run = {
+        "id": run_id,
+        "started_at": started_at.isoformat(),
+        "finished_at": datetime.now(timezone.utc).isoformat(),
+        "archived": sum(r['archived'] for r in reports),
+        "bytes_reclaimed": sum(r['bytes'] for r in reports),
+        "collections": reports
+    }
+    await db.archive_runs.insert_one(dict(run))
+    logger.info(f"Archival {run_id}: {run['archived']} documents, {run['bytes_reclaimed']} bytes reclaimed")
+    return run
+
+async def schedule_archival():
+    """Queue the next periodic run. The dedup key is the time slot, so every worker agrees on a single run."""
+    interval = settings.archive_interval_hours * 3600
+    next_slot = int(datetime.now(timezone.utc).timestamp() // interval) + 1
+    await job_queue.enqueue(
+        "archive_expired",
+        {"scheduled": True},
+        dedup_key=f"archive_expired:{next_slot}",
+        run_at=datetime.fromtimestamp(next_slot * interval, tz=timezone.utc)
+    )
+
+@job_handler("archive_expired")
+async def handle_archive_expired(payload: Dict[str, Any]):
+    await run_archival()
+    if payload.get('scheduled'):
+        await schedule_archival()
+
+# --- Catalog facets ---
+
+# One `catalog_facets` document per facet value ({facet, value, count,
+# in_stock}), adjusted with $inc on every product write so that the filter
+# sidebar reads O(categories) documents instead of the whole catalog.
+
+PRICE_BUCKETS = [(0, 20), (20, 40), (40, 60), (60, None)]
+
+def price_bucket_label(low: float, high: Optional[float]) -> str:
+    return f"{low}-{high}" if high is not None else f"{low}+"
+
+def product_facets(product: dict) -> List[tuple]:
+    bucket = next((low, high) for low, high in PRICE_BUCKETS if high is None or product['price'] < high)
+    return [("total", "all"), ("category", product['category']), ("price", price_bucket_label(*bucket))]
+
+def facet_updates(product: dict, sign: int) -> List[UpdateOne]:
+    in_stock = sign if product['stock'] > 0 else 0
+    return [
+        UpdateOne({"facet": facet, "value": value}, {"$inc": {"count": sign, "in_stock": in_stock}}, upsert=True)
+        for facet, value in product_facets(product)
+    ]
+
+class FacetsSnapshot:
+    """In-process copy of the facets, refreshed after `ttl` seconds or on local product writes."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._value: Optional[CatalogFacets] = None
+        self._expires = 0.0
+
+    def get(self) -> Optional[CatalogFacets]:
+        return self._value if time.monotonic() < self._expires else None
+
+    def set(self, value: CatalogFacets):
+        self._value, self._expires = value, time.monotonic() + self.ttl
+
+    def invalidate(self):
+        self._value = None
+        self._expires = 0.0
+
+async def update_facets(old: Optional[dict] = None, new: Optional[dict] = None):
+    operations = []
+    if old:
+        operations += facet_updates(old, -1)
+    if new:
+        operations += facet_updates(new, 1)
+    if operations:
+        await db.catalog_facets.bulk_write(operations, ordered=False)
+        await db.catalog_facets.delete_many({"count": {"$lte": 0}})
+    facets_snapshot.invalidate()
+
+async def rebuild_facets():
+    """Recount every facet from `products`; used to bootstrap or repair the counters."""
+    counts: Dict[tuple, Dict[str, int]] = {}
+    async for product in db.products.find({}, {"_id": 0, "category": 1, "price": 1, "stock": 1}):
+        for key in product_facets(product):
+            bucket = counts.setdefault(key, {"count": 0, "in_stock": 0})
+            bucket['count'] += 1
+            bucket['in_stock'] += 1 if product['stock'] > 0 else 0
+    await db.catalog_facets.delete_many({})
+    if counts:
+        await db.catalog_facets.insert_many([
+            {"facet": facet, "value": value, **bucket} for (facet, value), bucket in counts.items()
+        ])
+    facets_snapshot.invalidate()
+
+async def bootstrap_facets():
+    """Count the existing catalog once, at startup, before product writes start adjusting the counters.
+
+    The `total` document only goes away when the catalog is empty, so its
+    absence next to products means the counters were never built.
+    """
+    if not await db.catalog_facets.find_one({"facet": "total"}, {"_id": 1}) and await db.products.find_one({}, {"_id": 1}):
+        await rebuild_facets()
+
+async def load_facets() -> CatalogFacets:
+    rows = await db.catalog_facets.find({}, {"_id": 0}).to_list(None)
+
+    by_facet: Dict[str, Dict[str, dict]] = defaultdict(dict)
+    for row in rows:
+        by_facet[row['facet']][row['value']] = row
+    total = by_facet['total'].get('all', {"count": 0, "in_stock": 0})
+
+    price_buckets = []
+    for low, high in PRICE_BUCKETS:
+        row = by_facet['price'].get(price_bucket_label(low, high), {"count": 0, "in_stock": 0})
+        price_buckets.append(PriceBucket(
+            value=price_bucket_label(low, high), min=low, max=high, count=row['count'], in_stock=row['in_stock']
+        ))
+
+    return CatalogFacets(
+        total=total['count'],
+        in_stock=total['in_stock'],
+        categories=sorted(
+            (FacetValue(value=value, count=row['count'], in_stock=row['in_stock']) for value, row in by_facet['category'].items()),
+            key=lambda f: f.value
+        ),
+        price_buckets=price_buckets
+    )
+
+# --- Order export ---
+
+EXPORT_COLUMNS = [
+    "order_id", "created_at", "user_id", "total", "payment_status", "session_id", "item_count", "items",
+    "transaction_id", "transaction_status", "transaction_payment_status", "amount", "currency", "cursor"
+]
+
+def export_ranges(ranges: List[str]) -> List[tuple]:
+    """Parse "AAAA-MM-JJ..AAAA-MM-JJ" (or single day) ranges into merged [start, end) ISO bounds."""
+    bounds = []
+    for value in ranges or [today_key()]:
+        start, _, end = value.partition("..")
+        start, end = analytics_range(start, end or start)
+        end = (datetime.strptime(end, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+        bounds.append((start, end))
+    merged = []
+    for start, end in sorted(bounds):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def encode_export_cursor(order: dict) -> str:
+    raw = json.dumps([order['created_at'], order['id']]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_export_cursor(token: str) -> tuple:
+    try:
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+        return str(created_at), str(order_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Curseur d'export invalide")
+
+def export_query(ranges: List[tuple], cursor: Optional[str]) -> dict:
+    # created_at is stored as ISO strings, which compare in time order
+    query: Dict[str, Any] = {"$or": [{"created_at": {"$gte": start, "$lt": end}} for start, end in ranges]}
+    if cursor:
+        created_at, order_id = decode_export_cursor(cursor)
+        query = {"$and": [query, {"$or": [
+            {"created_at": {"$gt": created_at}},
+            {"created_at": created_at, "id": {"$gt": order_id}}
+        ]}]}
+    return query
+
+def export_row(order: dict, transaction: Optional[dict]) -> dict:
+    transaction = transaction or {}
+    return {
+        "order_id": order['id'],
+        "created_at": order['created_at'],
+        "user_id": order['user_id'],
+        "total": order['total'],
+        "payment_status": order['payment_status'],
+        "session_id": order.get('session_id'),
+        "item_count": sum(item['quantity'] for item in order['items']),
+        "items": order['items'],
+        "transaction_id": transaction.get('id'),
+        "transaction_status": transaction.get('status'),
+        "transaction_payment_status": transaction.get('payment_status'),
+        "amount": transaction.get('amount'),
+        "currency": transaction.get('currency'),
+        "cursor": encode_export_cursor(order)
+    }
+
+class ExportEncoder:
+    """Turns chunks of export rows into NDJSON or CSV bytes, optionally as one continuous gzip stream.
+
+    Each chunk is sync-flushed so that a partial download still decompresses
+    up to its last complete chunk, and can be resumed from the last `cursor`.
+    """
+
+    def __init__(self, fmt: str, compress: bool, header: bool):
+        self.fmt = fmt
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        self._header = header and fmt == "csv"
+
+    def encode(self, orders: List[dict], transactions: Dict[str, dict]) -> bytes:
+        rows = [export_row(order, transactions.get(order['id'])) for order in orders]
+        if self.fmt == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            if self._header:
+                writer.writerow(EXPORT_COLUMNS)
+                self._header = False
+            for row in rows:
+                row = {**row, "items": json.dumps(row['items'], separators=(",", ":"))}
+                writer.writerow([row[column] for column in EXPORT_COLUMNS])
+            data = buffer.getvalue().encode()
+        else:
+            data = "".join(json.dumps(row, separators=(",", ":")) + "\n" for row in rows).encode()
+        if self._compressor is not None:
+            data = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        return data
+
+    def finish(self) -> bytes:
+        return self._compressor.flush() if self._compressor is not None else b""
+
+async def stream_order_export(query: dict, encoder: ExportEncoder):
+    """Yield the export chunk by chunk from a server-side cursor, so memory stays bounded by one batch."""
+    batch_size = settings.export_batch_size
+    cursor = db.orders.find(query, {"_id": 0}).sort([("created_at", 1), ("id", 1)]).batch_size(batch_size)
+    try:
+        while True:
+            orders = await cursor.to_list(batch_size)
+            if not orders:
+                break
+            transactions = {}
+            # Oldest first so that the latest transaction of an order wins
+            async for transaction in db.payment_transactions.find(
+                {"order_id": {"$in": [order['id'] for order in orders]}}, {"_id": 0, "metadata": 0}
+            ).sort("created_at", 1):
+                transactions[transaction['order_id']] = transaction
+            # Serialization and compression run off the event loop
+            yield await run_in_threadpool(encoder.encode, orders, transactions)
+        yield encoder.finish()
+    finally:
+        await cursor.close()
+
 # --- Routes ---
 
 @api_router.get("/")
@@ -168,7 +1842,9 @@ async def root():
 
 # Auth Routes
 @api_router.post("/auth/register", response_model=Token)
-async def register(user_create: UserCreate):
+async def register(user_create: UserCreate, request: Request):
+    await enforce_rate_limit(request, "register")
+    
     # Check if user exists
     existing_user = await db.users.find_one({"email": user_create.email}, {"_id": 0})
     if existing_user:
@@ -177,14 +1853,20 @@ async def register(user_create: UserCreate):
     # Create user
     user_dict = user_create.model_dump()
     password = user_dict.pop('password')
+    guest_cart_token = user_dict.pop('guest_cart_token')
     user_obj = User(**user_dict)
-    user_in_db = UserInDB(**user_obj.model_dump(), password_hash=get_password_hash(password))
+    # bcrypt is CPU-bound: keep it off the event loop
+    password_hash = await run_in_threadpool(get_password_hash, password)
+    user_in_db = UserInDB(**user_obj.model_dump(), password_hash=password_hash)
     
     # Save to DB
     doc = user_in_db.model_dump()
     doc['created_at'] = doc['created_at'].isoformat()
     await db.users.insert_one(doc)
     
+    if guest_cart_token:
+        await merge_guest_cart(guest_cart_token, user_obj.id)
+    
     # Create token
     access_token = create_access_token(
         data={"sub": user_obj.id},
@@ -194,12 +1876,14 @@ async def register(user_create: UserCreate):
     return Token(access_token=access_token, token_type="bearer", user=user_obj)
 
 @api_router.post("/auth/login", response_model=Token)
-async def login(user_login: UserLogin):
+async def login(user_login: UserLogin, request: Request):
+    await enforce_rate_limit(request, "login", user_key=f"{client_ip(request)}:{user_login.email}")
+    
     user_doc = await db.users.find_one({"email": user_login.email}, {"_id": 0})
     if not user_doc:
         raise HTTPException(status_code=401, detail="Email ou mot de passe incorrect")
     
-    if not verify_password(user_login.password, user_doc['password_hash']):
+    if not await run_in_threadpool(verify_password, user_login.password, user_doc['password_hash']):
         raise HTTPException(status_code=401, detail="Email ou mot de passe incorrect")
     
     if isinstance(user_doc['created_at'], str):
@@ -207,6 +1891,9 @@ async def login(user_login: UserLogin):
     
     user = User(**{k: v for k, v in user_doc.items() if k != 'password_hash'})
     
+    if user_login.guest_cart_token:
+        await merge_guest_cart(user_login.guest_cart_token, user.id)
+    
     access_token = create_access_token(
         data={"sub": user.id},
         expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
@@ -227,32 +1914,109 @@ async def get_products(category: Optional[str] = None, search: Optional[str] = N
     if search:
         query['name'] = {'$regex': search, '$options': 'i'}
     
-    products = await db.products.find(query, {"_id": 0}).to_list(1000)
-    
-    for product in products:
-        if isinstance(product['created_at'], str):
-            product['created_at'] = datetime.fromisoformat(product['created_at'])
+    async def fetch_products():
+        products = await db.products.find(query, {"_id": 0}).to_list(1000)
+        
+        for product in products:
+            if isinstance(product['created_at'], str):
+                product['created_at'] = datetime.fromisoformat(product['created_at'])
+        
+        return products
     
-    return products
+    return await product_reads.do(("products", category, search), fetch_products)
+
+@api_router.get("/products/facets", response_model=CatalogFacets)
+async def get_product_facets():
+    facets = facets_snapshot.get()
+    if facets is None:
+        facets = await product_reads.do(("facets",), load_facets)
+        facets_snapshot.set(facets)
+    return facets
 
 @api_router.get("/products/{product_id}", response_model=Product)
 async def get_product(product_id: str):
-    product = await db.products.find_one({"id": product_id}, {"_id": 0})
+    async def fetch_product():
+        product = await db.products.find_one({"id": product_id}, {"_id": 0})
+        if product and isinstance(product['created_at'], str):
+            product['created_at'] = datetime.fromisoformat(product['created_at'])
+        return product
+    
+    product = await product_reads.do(("product", product_id), fetch_product)
     if not product:
         raise HTTPException(status_code=404, detail="Produit non trouvé")
     
-    if isinstance(product['created_at'], str):
-        product['created_at'] = datetime.fromisoformat(product['created_at'])
-    
     return Product(**product)
 
+# Image Routes
+@api_router.get("/images/{image_hash}/{variant}")
+async def get_image(image_hash: str, variant: str, request: Request):
+    width, _, fmt = variant.partition(".")
+    if not IMAGE_HASH_PATTERN.fullmatch(image_hash) or fmt not in IMAGE_FORMATS or not width.isdigit() or int(width) not in IMAGE_WIDTHS:
+        raise HTTPException(status_code=404, detail="Image non trouvée")
+    width = int(width)
+
+    etag = f'"{image_hash}-{width}.{fmt}"'
+    cache_headers = {"Cache-Control": "public, max-age=31536000, immutable", "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=cache_headers)
+
+    if not image_cache.original_path(image_hash).exists():
+        # The original is missing (fresh disk, another worker): fetch it again from its source
+        known = await db.images.find_one({"hash": image_hash}, {"_id": 0})
+        if not known or not known.get('source_url'):
+            raise HTTPException(status_code=404, detail="Image non trouvée")
+        await ingest_image_url(known['source_url'])
+        if not image_cache.original_path(image_hash).exists():
+            # The source now serves other bytes, stored under another hash
+            raise HTTPException(status_code=404, detail="Image non trouvée")
+
+    for _ in range(2):
+        path = await image_renders.do(
+            (image_hash, width, fmt),
+            lambda: run_in_threadpool(image_cache.render_variant, image_hash, width, fmt)
+        )
+        try:
+            return ranged_file_response(request, path, IMAGE_FORMATS[fmt], cache_headers)
+        except FileNotFoundError:
+            # Evicted between rendering and serving; render it again
+            continue
+    raise HTTPException(status_code=503, detail="Service momentanément surchargé, veuillez réessayer", headers={"Retry-After": "1"})
+
+@api_router.post("/admin/images")
+async def upload_image(file: UploadFile = File(...), product_id: Optional[str] = None, current_user: User = Depends(get_admin_user)):
+    data = await file.read(MAX_SOURCE_IMAGE_BYTES + 1)
+    if len(data) > MAX_SOURCE_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="Image trop volumineuse")
+    image_hash = await ingest_image(data)
+
+    if product_id:
+        result = await db.products.update_one({"id": product_id}, {"$set": {"image_hash": image_hash}})
+        if result.matched_count == 0:
+            raise HTTPException(status_code=404, detail="Produit non trouvé")
+
+    return {
+        "image_hash": image_hash,
+        "image_srcset": {fmt: image_srcset(image_hash, fmt) for fmt in IMAGE_FORMATS}
+    }
+
+@api_router.post("/admin/images/ingest-products")
+async def ingest_product_images(current_user: User = Depends(get_admin_user)):
+    products = await db.products.find(
+        {"image_hash": None, "image_url": {"$nin": [None, ""]}}, {"_id": 0, "id": 1, "image_url": 1}
+    ).to_list(None)
+    for product in products:
+        await enqueue_product_image(product['id'], product['image_url'])
+    return {"queued": len(products)}
+
 # Admin Product Routes
 @api_router.post("/admin/products", response_model=Product)
 async def create_product(product_create: ProductCreate, current_user: User = Depends(get_current_user)):
     product = Product(**product_create.model_dump())
-    doc = product.model_dump()
+    doc = product.model_dump(exclude={"image_srcset"})
     doc['created_at'] = doc['created_at'].isoformat()
     await db.products.insert_one(doc)
+    await update_facets(new=doc)
+    await enqueue_product_image(product.id, product.image_url)
     return product
 
 @api_router.put("/admin/products/{product_id}", response_model=Product)
@@ -262,9 +2026,17 @@ async def update_product(product_id: str, product_update: ProductCreate, current
         raise HTTPException(status_code=404, detail="Produit non trouvé")
     
     update_data = product_update.model_dump()
+    if update_data['image_url'] != existing['image_url']:
+        update_data['image_hash'] = None
     await db.products.update_one({"id": product_id}, {"$set": update_data})
+    if update_data['image_url'] != existing['image_url']:
+        await enqueue_product_image(product_id, update_data['image_url'])
     
     updated = await db.products.find_one({"id": product_id}, {"_id": 0})
+    await update_facets(old=existing, new=updated)
+    if any(updated[field] != existing[field] for field in ("price", "name", "category")):
+        await reprice_product_in_carts(updated)
+    
     if isinstance(updated['created_at'], str):
         updated['created_at'] = datetime.fromisoformat(updated['created_at'])
     
@@ -272,90 +2044,167 @@ async def update_product(product_id: str, product_update: ProductCreate, current
 
 @api_router.delete("/admin/products/{product_id}")
 async def delete_product(product_id: str, current_user: User = Depends(get_current_user)):
-    result = await db.products.delete_one({"id": product_id})
-    if result.deleted_count == 0:
+    deleted = await db.products.find_one_and_delete({"id": product_id}, projection={"_id": 0})
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Produit non trouvé")
+    await update_facets(old=deleted)
+    await remove_product_from_carts(product_id)
     return {"message": "Produit supprimé avec succès"}
 
 # Cart Routes
-@api_router.get("/cart", response_model=List[Dict[str, Any]])
-async def get_cart(current_user: User = Depends(get_current_user)):
-    cart_items = await db.cart_items.find({"user_id": current_user.id}, {"_id": 0}).to_list(1000)
+@api_router.post("/cart/guest", response_model=GuestCartToken)
+async def create_guest_cart():
+    return create_guest_cart_token()
+
+async def build_cart(owner: str, lookup: ProductLookup) -> Cart:
+    """The cart with its lines. Products already in `lookup` cost no query."""
+    cart = await db.carts.find_one({"user_id": owner}, {"_id": 0})
+    if cart is None:
+        cart = await recompute_cart(owner)
+    cart_items = await db.cart_items.find({"user_id": owner}, {"_id": 0}).to_list(1000)
+    
+    await lookup.load(item['product_id'] for item in cart_items)
     
-    result = []
+    lines = []
     for item in cart_items:
-        product = await db.products.find_one({"id": item['product_id']}, {"_id": 0})
+        product = lookup.get(item['product_id'])
         if product:
-            if isinstance(product['created_at'], str):
-                product['created_at'] = datetime.fromisoformat(product['created_at'])
-            result.append({
-                "cart_item_id": item['id'],
-                "product": Product(**product),
-                "quantity": item['quantity']
-            })
+            lines.append(CartLine(
+                cart_item_id=item['id'],
+                product=Product(**product),
+                quantity=item['quantity'],
+                unit_price=from_cents(item['unit_price_cents']),
+                line_total=from_cents(item['line_total_cents'])
+            ))
     
-    return result
+    return Cart(
+        items=lines,
+        item_count=cart['item_count'],
+        subtotal=from_cents(cart['subtotal_cents']),
+        subtotal_cents=cart['subtotal_cents']
+    )
+
+@api_router.get("/cart", response_model=Cart)
+async def get_cart(owner: str = Depends(get_cart_owner), lookup: ProductLookup = Depends(ProductLookup)):
+    return await build_cart(owner, lookup)
 
 @api_router.post("/cart", response_model=CartItem)
-async def add_to_cart(cart_item_add: CartItemAdd, current_user: User = Depends(get_current_user)):
+async def add_to_cart(cart_item_add: CartItemAdd, owner: str = Depends(get_cart_owner)):
     # Check if product exists
     product = await db.products.find_one({"id": cart_item_add.product_id}, {"_id": 0})
     if not product:
         raise HTTPException(status_code=404, detail="Produit non trouvé")
     
-    # Check if already in cart
-    existing = await db.cart_items.find_one({
-        "user_id": current_user.id,
-        "product_id": cart_item_add.product_id
-    }, {"_id": 0})
-    
-    if existing:
-        # Update quantity
-        new_quantity = existing['quantity'] + cart_item_add.quantity
-        await db.cart_items.update_one(
-            {"id": existing['id']},
-            {"$set": {"quantity": new_quantity}}
-        )
-        existing['quantity'] = new_quantity
-        return CartItem(**existing)
+    # Add to the existing line or create it, in one atomic upsert
+    query, update = cart_line_increment(owner, product, cart_item_add.quantity)
+    line = await db.cart_items.find_one_and_update(
+        query, update, upsert=True, return_document=ReturnDocument.AFTER, projection={"_id": 0}
+    )
+    
+    if line['line_total_cents'] == line['unit_price_cents'] * line['quantity']:
+        await apply_cart_delta(owner, line['unit_price_cents'] * cart_item_add.quantity, cart_item_add.quantity)
     else:
-        # Add new item
-        cart_item = CartItem(
-            user_id=current_user.id,
-            product_id=cart_item_add.product_id,
-            quantity=cart_item_add.quantity
-        )
-        await db.cart_items.insert_one(cart_item.model_dump())
-        return cart_item
+        # The line was priced before a price change or before snapshots existed
+        await realign_cart_lines({"id": line['id']})
+        line = await db.cart_items.find_one({"id": line['id']}, {"_id": 0})
+        await recompute_cart(owner)
+    
+    if line['quantity'] == cart_item_add.quantity and await db.cart_items.count_documents({"user_id": owner}, limit=2) == 1:
+        await record_funnel_event("carts_started")
+    if is_guest(owner):
+        await touch_guest_cart(owner)
+    return CartItem(**line)
 
 @api_router.delete("/cart/{cart_item_id}")
-async def remove_from_cart(cart_item_id: str, current_user: User = Depends(get_current_user)):
-    result = await db.cart_items.delete_one({
+async def remove_from_cart(cart_item_id: str, owner: str = Depends(get_cart_owner)):
+    removed = await db.cart_items.find_one_and_delete({
         "id": cart_item_id,
-        "user_id": current_user.id
-    })
-    if result.deleted_count == 0:
+        "user_id": owner
+    }, projection={"_id": 0})
+    if removed is None:
         raise HTTPException(status_code=404, detail="Article non trouvé dans le panier")
+    if 'line_total_cents' in removed:
+        await apply_cart_delta(owner, -removed['line_total_cents'], -removed['quantity'])
+    else:
+        await recompute_cart(owner)
+    if is_guest(owner):
+        await touch_guest_cart(owner)
     return {"message": "Article supprimé du panier"}
 
 @api_router.delete("/cart")
-async def clear_cart(current_user: User = Depends(get_current_user)):
-    await db.cart_items.delete_many({"user_id": current_user.id})
+async def clear_cart(owner: str = Depends(get_cart_owner)):
+    await empty_cart(owner)
     return {"message": "Panier vidé"}
 
 # Order Routes
+@api_router.get("/orders/summary", response_model=OrderSummary)
+async def get_order_summary(before: Optional[datetime] = None, current_user: User = Depends(get_current_user)):
+    """Counters and the latest orders. Pass the `created_at` of the last entry as `before` for the next page."""
+    summary = await db.order_summaries.find_one({"user_id": current_user.id}, {"_id": 0})
+    if summary is None:
+        summary = await rebuild_order_summary(current_user.id)
+    if before is None:
+        summary['has_more'] = summary['order_count'] > len(summary['orders'])
+    else:
+        summary['orders'], summary['has_more'] = await order_history_page(current_user.id, before)
+    return OrderSummary(**summary)
+
+async def enrich_order_items(orders: List[dict], lookup: ProductLookup):
+    """Attach the current product and its availability to every line of the given orders."""
+    await lookup.load(item['product_id'] for order in orders for item in order['items'])
+    for order in orders:
+        for item in order['items']:
+            product = lookup.get(item['product_id'])
+            item['current_product'] = Product(**product).model_dump(mode="json") if product else None
+            item['discontinued'] = product is None
+            item['available'] = product is not None and product['stock'] > 0
+
 @api_router.get("/orders", response_model=List[Order])
-async def get_orders(current_user: User = Depends(get_current_user)):
+async def get_orders(enrich: bool = False, current_user: User = Depends(get_current_user), lookup: ProductLookup = Depends(ProductLookup)):
     orders = await db.orders.find({"user_id": current_user.id}, {"_id": 0}).sort("created_at", -1).to_list(1000)
     
     for order in orders:
         if isinstance(order['created_at'], str):
             order['created_at'] = datetime.fromisoformat(order['created_at'])
     
+    if enrich:
+        await enrich_order_items(orders, lookup)
+    
     return orders
 
+@api_router.post("/orders/reorder", response_model=ReorderResult)
+async def reorder(reorder_req: ReorderRequest, current_user: User = Depends(get_current_user), lookup: ProductLookup = Depends(ProductLookup)):
+    orders = await db.orders.find(
+        {"id": {"$in": reorder_req.order_ids}, "user_id": current_user.id}, {"_id": 0, "items": 1}
+    ).to_list(None)
+    if not orders:
+        raise HTTPException(status_code=404, detail="Commande non trouvée")
+    
+    items = [item for order in orders for item in order['items']]
+    await lookup.load(item['product_id'] for item in items)
+    
+    quantities: Dict[str, int] = defaultdict(int)
+    skipped = {}
+    for item in items:
+        product = lookup.get(item['product_id'])
+        if product is None:
+            skipped[item['product_id']] = ReorderSkippedItem(product_id=item['product_id'], name=item['name'], reason="discontinued")
+        elif product['stock'] <= 0:
+            skipped[item['product_id']] = ReorderSkippedItem(product_id=item['product_id'], name=product['name'], reason="out_of_stock")
+        else:
+            quantities[item['product_id']] += item['quantity']
+    
+    await bulk_add_to_cart(current_user.id, quantities, lookup)
+    
+    return ReorderResult(
+        added=len(quantities),
+        skipped=list(skipped.values()),
+        # Reordered products are already in the lookup
+        cart=await build_cart(current_user.id, lookup)
+    )
+
 @api_router.get("/orders/{order_id}", response_model=Order)
-async def get_order(order_id: str, current_user: User = Depends(get_current_user)):
+async def get_order(order_id: str, enrich: bool = False, current_user: User = Depends(get_current_user), lookup: ProductLookup = Depends(ProductLookup)):
     order = await db.orders.find_one({"id": order_id, "user_id": current_user.id}, {"_id": 0})
     if not order:
         raise HTTPException(status_code=404, detail="Commande non trouvée")
@@ -363,33 +2212,158 @@ async def get_order(order_id: str, current_user: User = Depends(get_current_user
     if isinstance(order['created_at'], str):
         order['created_at'] = datetime.fromisoformat(order['created_at'])
     
+    if enrich:
+        await enrich_order_items([order], lookup)
+    
     return Order(**order)
 
+# Admin Analytics Routes
+@api_router.get("/admin/analytics/revenue", response_model=RevenueReport)
+async def get_revenue_report(start: Optional[str] = None, end: Optional[str] = None, current_user: User = Depends(get_admin_user)):
+    start, end = analytics_range(start, end)
+    day_range = {"day": {"$gte": start, "$lte": end}}
+
+    days = await db.analytics_daily.find(day_range, {"_id": 0}).sort("day", 1).to_list(None)
+    days = [DailyRevenue(**d) for d in days]
+
+    categories: Dict[str, CategoryRevenue] = {}
+    async for row in db.analytics_category_daily.find(day_range, {"_id": 0}):
+        current = categories.setdefault(row['category'], CategoryRevenue(category=row['category'], revenue=0.0, units=0))
+        current.revenue += row.get('revenue', 0.0)
+        current.units += row.get('units', 0)
+
+    return RevenueReport(
+        start=start,
+        end=end,
+        revenue=sum(d.revenue for d in days),
+        orders_paid=sum(d.orders_paid for d in days),
+        units=sum(d.units for d in days),
+        days=days,
+        categories=sorted(categories.values(), key=lambda c: c.revenue, reverse=True)
+    )
+
+@api_router.get("/admin/analytics/products", response_model=List[ProductSales])
+async def get_product_sales(start: Optional[str] = None, end: Optional[str] = None, limit: int = 20, current_user: User = Depends(get_admin_user)):
+    start, end = analytics_range(start, end)
+
+    products: Dict[str, ProductSales] = {}
+    async for row in db.analytics_product_daily.find({"day": {"$gte": start, "$lte": end}}, {"_id": 0}):
+        current = products.setdefault(row['product_id'], ProductSales(product_id=row['product_id'], name=row['name'], units=0, revenue=0.0))
+        current.units += row.get('units', 0)
+        current.revenue += row.get('revenue', 0.0)
+
+    return sorted(products.values(), key=lambda p: p.units, reverse=True)[:limit]
+
+@api_router.get("/admin/analytics/conversion", response_model=ConversionReport)
+async def get_conversion_report(start: Optional[str] = None, end: Optional[str] = None, current_user: User = Depends(get_admin_user)):
+    start, end = analytics_range(start, end)
+    days = await db.analytics_daily.find({"day": {"$gte": start, "$lte": end}}, {"_id": 0}).to_list(None)
+
+    carts = sum(d.get('carts_started', 0) for d in days)
+    checkouts = sum(d.get('checkouts_started', 0) for d in days)
+    paid = sum(d.get('orders_paid', 0) for d in days)
+
+    def rate(numerator: int, denominator: int) -> float:
+        return round(numerator / denominator, 4) if denominator else 0.0
+
+    return ConversionReport(
+        start=start,
+        end=end,
+        carts_started=carts,
+        checkouts_started=checkouts,
+        orders_paid=paid,
+        cart_to_checkout_rate=rate(checkouts, carts),
+        checkout_to_paid_rate=rate(paid, checkouts),
+        cart_to_paid_rate=rate(paid, carts)
+    )
+
+@api_router.get("/admin/analytics/low-stock", response_model=List[Product])
+async def get_low_stock_products(threshold: int = 5, current_user: User = Depends(get_admin_user)):
+    products = await db.products.find({"stock": {"$lte": threshold}}, {"_id": 0}).sort("stock", 1).to_list(1000)
+
+    for product in products:
+        if isinstance(product['created_at'], str):
+            product['created_at'] = datetime.fromisoformat(product['created_at'])
+
+    return products
+
+@api_router.get("/admin/metrics/coalescing")
+async def get_coalescing_metrics(current_user: User = Depends(get_admin_user)):
+    return product_reads.stats()
+
+@api_router.post("/admin/facets/rebuild", response_model=CatalogFacets)
+async def rebuild_product_facets(current_user: User = Depends(get_admin_user)):
+    await rebuild_facets()
+    return await load_facets()
+
+# Admin Retention Routes
+@api_router.post("/admin/retention/run", status_code=202)
+async def trigger_archival(current_user: User = Depends(get_admin_user)):
+    await job_queue.enqueue("archive_expired", {"scheduled": False}, dedup_key=f"archive_expired:manual:{uuid.uuid4()}")
+    return {"message": "Archivage programmé"}
+
+@api_router.get("/admin/retention/runs")
+async def get_archival_runs(limit: int = 20, current_user: User = Depends(get_admin_user)):
+    return await db.archive_runs.find({}, {"_id": 0}).sort("started_at", -1).to_list(limit)
+
+@api_router.get("/admin/orders/export")
+async def export_orders(
+    request: Request,
+    ranges: List[str] = Query(default=[], alias="range"),
+    format: str = "ndjson",
+    compress: bool = False,
+    cursor: Optional[str] = None,
+    current_user: User = Depends(get_admin_user)
+):
+    """Stream orders joined with their latest payment transaction, oldest first.
+
+    `range` may be repeated (AAAA-MM-JJ..AAAA-MM-JJ or a single day). Every row
+    carries a `cursor`; passing the last one received resumes the export right
+    after that row. The CSV header is only written on the first page.
+    """
+    await enforce_rate_limit(request, "order_export", user_key=current_user.id)
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Format d'export inconnu (ndjson ou csv)")
+    query = export_query(export_ranges(ranges), cursor)
+    encoder = ExportEncoder(format, compress, header=cursor is None)
+
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv; charset=utf-8"
+    filename = f"orders-{today_key()}.{format}"
+    if compress:
+        media_type = "application/gzip"
+        filename += ".gz"
+    return StreamingResponse(
+        stream_order_export(query, encoder),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
 # Payment Routes
-@api_router.post("/checkout/session", response_model=CheckoutSessionResponse)
-async def create_checkout_session(checkout_req: CheckoutRequest, current_user: User = Depends(get_current_user)):
-    # Get cart items
+@api_router.post("/checkout/session")
+async def create_checkout_session(checkout_req: CheckoutRequest, request: Request, current_user: User = Depends(get_current_user)):
+    await enforce_rate_limit(request, "checkout_session", user_key=current_user.id)
+    
+    # Get cart items; their price snapshots are kept current by the cart pricing engine
     cart_items = await db.cart_items.find({"user_id": current_user.id}, {"_id": 0}).to_list(1000)
     
+    if any('unit_price_cents' not in item for item in cart_items):
+        await recompute_cart(current_user.id)
+        cart_items = await db.cart_items.find({"user_id": current_user.id}, {"_id": 0}).to_list(1000)
+    
     if not cart_items:
         raise HTTPException(status_code=400, detail="Votre panier est vide")
     
-    # Calculate total and prepare order items
-    total = 0.0
-    order_items = []
-    
-    for item in cart_items:
-        product = await db.products.find_one({"id": item['product_id']}, {"_id": 0})
-        if product:
-            item_total = product['price'] * item['quantity']
-            total += item_total
-            order_items.append({
-                "product_id": product['id'],
-                "name": product['name'],
-                "price": product['price'],
-                "quantity": item['quantity'],
-                "subtotal": item_total
-            })
+    # Calculate total (in cents) and prepare order items
+    total_cents = sum(item['line_total_cents'] for item in cart_items)
+    total = from_cents(total_cents)
+    order_items = [{
+        "product_id": item['product_id'],
+        "name": item['name'],
+        "category": item['category'],
+        "price": from_cents(item['unit_price_cents']),
+        "quantity": item['quantity'],
+        "subtotal": from_cents(item['line_total_cents'])
+    } for item in cart_items]
     
     # Create order
     order = Order(
@@ -401,17 +2375,20 @@ async def create_checkout_session(checkout_req: CheckoutRequest, current_user: U
     order_doc = order.model_dump()
     order_doc['created_at'] = order_doc['created_at'].isoformat()
     await db.orders.insert_one(order_doc)
+    await record_order_created(order_doc)
+    await record_funnel_event("checkouts_started")
     
     # Create Stripe checkout session
-    stripe_checkout = StripeCheckout(
-        api_key=STRIPE_API_KEY,
+    checkout = stripe_checkout_module()
+    stripe_checkout = checkout.StripeCheckout(
+        api_key=settings.stripe_api_key,
         webhook_url=f"{checkout_req.origin_url}/api/webhook/stripe"
     )
     
     success_url = f"{checkout_req.origin_url}/checkout/success?session_id={{CHECKOUT_SESSION_ID}}"
     cancel_url = f"{checkout_req.origin_url}/checkout/cancel"
     
-    checkout_request = CheckoutSessionRequest(
+    checkout_request = checkout.CheckoutSessionRequest(
         amount=total,
         currency="eur",
         success_url=success_url,
@@ -447,8 +2424,10 @@ async def create_checkout_session(checkout_req: CheckoutRequest, current_user: U
     
     return session
 
-@api_router.get("/checkout/status/{session_id}", response_model=CheckoutStatusResponse)
-async def get_checkout_status(session_id: str, current_user: User = Depends(get_current_user)):
+@api_router.get("/checkout/status/{session_id}")
+async def get_checkout_status(session_id: str, request: Request, current_user: User = Depends(get_current_user)):
+    await enforce_rate_limit(request, "checkout_status", user_key=current_user.id)
+    
     # Check if already processed
     transaction = await db.payment_transactions.find_one({"session_id": session_id}, {"_id": 0})
     if not transaction:
@@ -456,7 +2435,7 @@ async def get_checkout_status(session_id: str, current_user: User = Depends(get_
     
     if transaction['payment_status'] == 'paid':
         # Already processed, return cached status
-        return CheckoutStatusResponse(
+        return stripe_checkout_module().CheckoutStatusResponse(
             status=transaction['status'],
             payment_status=transaction['payment_status'],
             amount_total=int(transaction['amount'] * 100),
@@ -465,9 +2444,9 @@ async def get_checkout_status(session_id: str, current_user: User = Depends(get_
         )
     
     # Get status from Stripe
-    stripe_checkout = StripeCheckout(
-        api_key=STRIPE_API_KEY,
-        webhook_url=f"{os.environ.get('REACT_APP_BACKEND_URL', '')}/api/webhook/stripe"
+    stripe_checkout = stripe_checkout_module().StripeCheckout(
+        api_key=settings.stripe_api_key,
+        webhook_url=f"{settings.backend_url}/api/webhook/stripe"
     )
     
     checkout_status = await stripe_checkout.get_checkout_status(session_id)
@@ -481,17 +2460,11 @@ async def get_checkout_status(session_id: str, current_user: User = Depends(get_
         }}
     )
     
-    # If payment is complete, update order and clear cart
+    # If payment is complete, the order update and cart cleanup run in the background
     if checkout_status.payment_status == 'paid' and transaction['payment_status'] != 'paid':
         order_id = transaction.get('metadata', {}).get('order_id')
         if order_id:
-            await db.orders.update_one(
-                {"id": order_id},
-                {"$set": {"payment_status": "paid"}}
-            )
-        
-        # Clear user's cart
-        await db.cart_items.delete_many({"user_id": current_user.id})
+            await enqueue_order_paid(order_id)
     
     return checkout_status
 
@@ -500,8 +2473,8 @@ async def stripe_webhook(request: Request):
     body = await request.body()
     signature = request.headers.get("Stripe-Signature")
     
-    stripe_checkout = StripeCheckout(
-        api_key=STRIPE_API_KEY,
+    stripe_checkout = stripe_checkout_module().StripeCheckout(
+        api_key=settings.stripe_api_key,
         webhook_url=""
     )
     
@@ -520,33 +2493,139 @@ async def stripe_webhook(request: Request):
         if webhook_response.payment_status == "paid":
             order_id = webhook_response.metadata.get('order_id')
             if order_id:
-                await db.orders.update_one(
-                    {"id": order_id},
-                    {"$set": {"payment_status": "paid"}}
-                )
+                await enqueue_order_paid(order_id)
         
         return {"status": "success"}
     except Exception as e:
         logging.error(f"Webhook error: {str(e)}")
         raise HTTPException(status_code=400, detail=str(e))
 
-# Include router
-app.include_router(api_router)
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_credentials=True,
-    allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
+async def start_load_shedder():
+    load_shedder.start()
+
+async def start_job_workers():
+    job_queue.start()
+
+async def ensure_indexes():
+    await db.orders.create_index([("user_id", 1), ("created_at", -1)])
+    await db.order_summaries.create_index("user_id", unique=True)
+    await db.products.create_index("stock")
+    await db.analytics_daily.create_index("day", unique=True)
+    await db.analytics_product_daily.create_index([("day", 1), ("product_id", 1)], unique=True)
+    await db.analytics_category_daily.create_index([("day", 1), ("category", 1)], unique=True)
+    await db.rate_limits.create_index("key", unique=True)
+    await db.rate_limits.create_index("updated_at", expireAfterSeconds=3600)
+    await db.jobs.create_index([("status", 1), ("run_at", 1)])
+    await db.jobs.create_index("dedup_key", unique=True, partialFilterExpression={"dedup_key": {"$type": "string"}})
+    await db.jobs.create_index("completed_at", expireAfterSeconds=7 * 24 * 3600)
+    await db.images.create_index("hash", unique=True)
+    await db.images.create_index("source_url")
+    await merge_duplicate_cart_lines()
+    try:
+        await db.cart_items.create_index([("user_id", 1), ("product_id", 1)], unique=True)
+    except OperationFailure as e:
+        if e.code not in (85, 86):  # IndexOptionsConflict, IndexKeySpecsConflict
+            raise
+        # Replaces the non-unique index of the same name
+        await db.cart_items.drop_index([("user_id", 1), ("product_id", 1)])
+        await db.cart_items.create_index([("user_id", 1), ("product_id", 1)], unique=True)
+    await db.cart_items.create_index("product_id")
+    await db.carts.create_index("user_id", unique=True)
+    await db.cart_items.create_index("expires_at", expireAfterSeconds=0)
+    await db.carts.create_index("expires_at", expireAfterSeconds=0)
+    await db.archive_runs.create_index("started_at")
+    await db.catalog_facets.create_index([("facet", 1), ("value", 1)], unique=True)
+    await db.carts.create_index("updated_at")
+    await db.orders.create_index([("payment_status", 1), ("created_at", 1)])
+    await db.payment_transactions.create_index([("payment_status", 1), ("created_at", 1)])
+    await db.orders.create_index([("created_at", 1), ("id", 1)])
+    await db.payment_transactions.create_index([("order_id", 1), ("created_at", 1)])
+    await ensure_retention_ttl_indexes()
+    await schedule_archival()
+    await bootstrap_facets()
+
 async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+    load_shedder.stop()
+    await job_queue.stop()
+    client.close()
+
+# --- App factory ---
+
+class Runtime:
+    """The state of one application. The Mongo client connects lazily, so no database is needed until the first query."""
+
+    def __init__(self, settings: Settings):
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        self.settings = settings
+        pool_listener = PoolWaitQueueListener()
+        self.client = AsyncIOMotorClient(settings.mongo_url, event_listeners=[pool_listener])
+        self.db = self.client[settings.db_name]
+        self.load_shedder = LoadShedder(
+            pool_listener,
+            max_loop_lag=settings.shed_loop_lag_ms / 1000,
+            max_pool_waiters=settings.shed_pool_waiters
+        )
+        if settings.rate_limit_backend == 'mongo':
+            self.rate_limit_backend = MongoRateLimitBackend(self.db.rate_limits)
+        else:
+            self.rate_limit_backend = InMemoryRateLimitBackend()
+        self.job_queue = JobQueue(self.db.jobs, self.db.jobs_dead_letter, JOB_HANDLERS, workers=settings.job_workers)
+        self.product_reads = SingleFlight(max_waiters=settings.singleflight_max_waiters)
+        self.image_cache = ImageCache(Path(settings.image_cache_dir), max_bytes=settings.image_cache_max_mb * 1024 * 1024)
+        self.image_renders = SingleFlight(max_waiters=settings.singleflight_max_waiters)
+        self.facets_snapshot = FacetsSnapshot(ttl=settings.facets_cache_seconds)
+
+class RuntimeMiddleware:
+    """Activates the app's Runtime for every request and for the lifespan events, and records the request's base URL."""
+
+    def __init__(self, app, runtime: Runtime):
+        self.app = app
+        self.runtime = runtime
+
+    async def __call__(self, scope, receive, send):
+        token = _active_runtime.set(self.runtime)
+        base_url_token = _request_base_url.set(str(Request(scope).base_url) if scope["type"] == "http" else "")
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_base_url.reset(base_url_token)
+            _active_runtime.reset(token)
+
+def create_app(app_settings: Optional[Settings] = None) -> FastAPI:
+    """Build an application with its own Runtime, available as app.state.runtime."""
+    runtime = Runtime(app_settings or Settings.from_env())
+    
+    app = FastAPI()
+    app.state.runtime = runtime
+    app.include_router(api_router)
+    
+    app.add_middleware(
+        CORSMiddleware,
+        allow_credentials=True,
+        allow_origins=runtime.settings.cors_origins,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    app.add_middleware(RuntimeMiddleware, runtime=runtime)
+    
+    app.add_event_handler("startup", start_load_shedder)
+    app.add_event_handler("startup", start_job_workers)
+    app.add_event_handler("startup", ensure_indexes)
+    app.add_event_handler("shutdown", shutdown_db_client)
+    return app
+
+def __getattr__(name: str):
+    # Keeps `uvicorn server:app` working: the app is built from the environment
+    # on first access instead of at import time.
+    if name == "app":
+        global app
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
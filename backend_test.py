@@ -197,8 +197,8 @@ class EcommerceAPITester:
             return False
             
         # Remove from cart
-        if cart_with_items and len(cart_with_items) > 0:
-            cart_item_id = cart_with_items[0]['cart_item_id']
+        if cart_with_items and len(cart_with_items['items']) > 0:
+            cart_item_id = cart_with_items['items'][0]['cart_item_id']
             remove_response = self.run_test("Remove from Cart", "DELETE", f"cart/{cart_item_id}", 200)
             return remove_response is not None
             
@@ -12,8 +12,10 @@ const API = `${BACKEND_URL}/api`;
 const AccountPage = () => {
   const { user, token, logout } = useAuth();
   const navigate = useNavigate();
-  const [orders, setOrders] = useState([]);
+  const [summary, setSummary] = useState(null);
+  const [orderDetails, setOrderDetails] = useState({});
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
 
   useEffect(() => {
     if (!user) {
@@ -26,10 +28,10 @@ const AccountPage = () => {
   const fetchOrders = async () => {
     try {
       setLoading(true);
-      const response = await axios.get(`${API}/orders`, {
+      const response = await axios.get(`${API}/orders/summary`, {
         headers: { Authorization: `Bearer ${token}` },
       });
-      setOrders(response.data);
+      setSummary(response.data);
     } catch (error) {
       console.error('Error fetching orders:', error);
       toast.error('Erreur lors du chargement des commandes');
@@ -38,6 +40,45 @@ const AccountPage = () => {
     }
   };
 
+  const loadMoreOrders = async () => {
+    const oldest = summary.orders[summary.orders.length - 1];
+    try {
+      setLoadingMore(true);
+      const response = await axios.get(`${API}/orders/summary`, {
+        params: { before: oldest.created_at },
+        headers: { Authorization: `Bearer ${token}` },
+      });
+      setSummary((current) => ({
+        ...current,
+        orders: [...current.orders, ...response.data.orders],
+        has_more: response.data.has_more,
+      }));
+    } catch (error) {
+      console.error('Error fetching orders:', error);
+      toast.error('Erreur lors du chargement des commandes');
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
+  const toggleOrderDetail = async (orderId) => {
+    if (orderDetails[orderId]) {
+      setOrderDetails(({ [orderId]: _, ...rest }) => rest);
+      return;
+    }
+    try {
+      const response = await axios.get(`${API}/orders/${orderId}`, {
+        headers: { Authorization: `Bearer ${token}` },
+      });
+      setOrderDetails((details) => ({ ...details, [orderId]: response.data }));
+    } catch (error) {
+      console.error('Error fetching order:', error);
+      toast.error('Erreur lors du chargement de la commande');
+    }
+  };
+
+  const orders = summary ? summary.orders : [];
+
   if (!user) return null;
 
   return (
@@ -73,7 +114,13 @@ const AccountPage = () => {
 
           {/* Orders */}
           <div className="lg:col-span-2">
-            <h2 className="text-2xl font-normal mb-6">Mes Commandes</h2>
+            <h2 className="text-2xl font-normal mb-2">Mes Commandes</h2>
+            {summary && summary.order_count > 0 && (
+              <p className="text-sm text-muted-foreground mb-6" data-testid="orders-summary">
+                {summary.order_count} commande{summary.order_count > 1 ? 's' : ''} ·{' '}
+                {summary.lifetime_spend.toFixed(2)}€ dépensés
+              </p>
+            )}
             
             {loading ? (
               <p className="text-muted-foreground" data-testid="loading">Chargement...</p>
@@ -110,12 +157,24 @@ const AccountPage = () => {
                     </div>
                     
                     <div className="space-y-2 mb-4">
-                      {order.items.map((item, idx) => (
-                        <div key={idx} className="flex justify-between text-sm">
-                          <span>{item.name} x {item.quantity}</span>
-                          <span>{item.subtotal.toFixed(2)}€</span>
-                        </div>
-                      ))}
+                      {orderDetails[order.id]
+                        ? orderDetails[order.id].items.map((item, idx) => (
+                            <div key={idx} className="flex justify-between text-sm">
+                              <span>{item.name} x {item.quantity}</span>
+                              <span>{item.subtotal.toFixed(2)}€</span>
+                            </div>
+                          ))
+                        : order.lines.map((line, idx) => (
+                            <div key={idx} className="text-sm">{line}</div>
+                          ))}
+                      <button
+                        type="button"
+                        onClick={() => toggleOrderDetail(order.id)}
+                        className="text-xs text-primary underline"
+                        data-testid={`order-detail-toggle-${order.id}`}
+                      >
+                        {orderDetails[order.id] ? 'Masquer le détail' : 'Voir le détail'}
+                      </button>
                     </div>
                     
                     <div className="border-t border-border pt-4 flex justify-between font-medium">
@@ -124,6 +183,17 @@ const AccountPage = () => {
                     </div>
                   </div>
                 ))}
+                {summary.has_more && (
+                  <Button
+                    onClick={loadMoreOrders}
+                    variant="outline"
+                    className="w-full"
+                    disabled={loadingMore}
+                    data-testid="load-more-orders"
+                  >
+                    {loadingMore ? 'Chargement...' : 'Voir les commandes précédentes'}
+                  </Button>
+                )}
               </div>
             )}
           </div>
@@ -128,6 +128,7 @@ const ProductsPage = () => {
                   <div className="relative aspect-[3/4] mb-4 overflow-hidden bg-muted">
                     <img
                       src={product.image_url}
+                      loading="lazy"
                       alt={product.name}
                       className="w-full h-full object-cover transition-transform duration-500 group-hover:scale-105"
                     />
@@ -0,0 +1,88 @@
+import argparse
+import subprocess
+import sys
+from pathlib import Path
+
+# Measures `import server` with `python -X importtime` and fails when the
+# cumulative import time goes over budget, or when a dependency that server.py
+# defers to first use gets imported eagerly again. Importing the module must
+# not need a database or the environment: the app is only built by create_app().
+#
+# Reference measurements (fastest of 15 runs, same machine, Stripe stack
+# replaced by an empty package since it is not installable there):
+#   baseline, everything imported eagerly     774 ms
+#   just before create_app() was introduced   824 ms
+#   with create_app() and deferred imports    589-669 ms (fastapi alone ~400 ms)
+# The budget is 1.5x the deferred-import figure so that machine noise does not
+# fail the check; the deferred-import check catches smaller regressions.
+
+BACKEND_DIR = Path(__file__).parent.parent / 'backend'
+DEFERRED_MODULES = ('motor', 'passlib', 'jose', 'emergentintegrations', 'PIL', 'httpx')
+
+def eagerly_imported():
+    result = subprocess.run(
+        [sys.executable, '-c', f'import sys, server; print(" ".join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))'],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+    return result.stdout.split()
+
+def measure_import():
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import server'],
+        cwd=BACKEND_DIR,
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(result.returncode)
+
+    # Lines look like "import time:  self [us] | cumulative | imported package",
+    # nested imports are indented by two spaces per level under their parent
+    # and listed before it.
+    total = None
+    children = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        name = name[1:]
+        if name == 'server':
+            total = int(cumulative)
+            break
+        if name.startswith('  ') and not name.startswith('    '):
+            children.append((int(cumulative), name.strip()))
+        elif not name.startswith(' '):
+            children = []
+    return total, children
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of backend/server.py")
+    parser.add_argument('--budget-ms', type=float, default=1000, help="maximum cumulative import time in milliseconds")
+    parser.add_argument('--runs', type=int, default=5, help="number of measurements, the fastest one is kept")
+    parser.add_argument('--top', type=int, default=10, help="number of slowest imports to list")
+    args = parser.parse_args()
+
+    total, timings = min((measure_import() for _ in range(args.runs)), key=lambda m: m[0])
+
+    print("Slowest imports made by server.py:")
+    for us, name in sorted(timings, reverse=True)[:args.top]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+    print(f"\nTotal: {total / 1000:.1f} ms (budget {args.budget_ms:.0f} ms)")
+
+    eager = eagerly_imported()
+    if eager:
+        print(f"✗ Imported eagerly, should be deferred to first use: {', '.join(eager)}")
+        sys.exit(1)
+    if total / 1000 > args.budget_ms:
+        print("✗ Import time over budget")
+        sys.exit(1)
+    print("✓ Import time within budget")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,36 @@
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+
+def build_app(tmp_path, name):
+    return server.create_app(server.Settings(
+        mongo_url='mongodb://localhost:27017',
+        db_name=f'test_{name}',
+        image_cache_dir=str(tmp_path / name)
+    ))
+
+
+def test_each_app_keeps_its_own_runtime(tmp_path):
+    first = build_app(tmp_path, 'first')
+    image_hash = first.state.runtime.image_cache.store_original((FIXTURES / 'landscape.jpg').read_bytes())
+
+    # Building another app must not take over the first one's state
+    second = build_app(tmp_path, 'second')
+
+    assert first.state.runtime is not second.state.runtime
+    assert first.state.runtime.settings.db_name == 'test_first'
+    response = TestClient(first).get(f'/api/images/{image_hash}/320.webp')
+    assert response.status_code == 200
+    assert (tmp_path / 'first' / 'variants' / f'{image_hash}-320.webp').exists()
+    assert not (tmp_path / 'second' / 'variants').joinpath(f'{image_hash}-320.webp').exists()
+
+
+def test_runtime_is_only_reachable_from_an_app():
+    with pytest.raises(RuntimeError):
+        server.db.products
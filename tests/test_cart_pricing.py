@@ -0,0 +1,114 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+import server
+
+PRODUCT = {'id': 'p1', 'name': 'Sérum éclat', 'category': 'soins', 'price': 12.5}
+
+
+@pytest.mark.parametrize('amount, cents', [
+    (19.99, 1999),
+    (0.1 + 0.2, 30),
+    (0.285, 29),
+    (1.005, 101),
+    (0, 0),
+    (120, 12000),
+])
+def test_to_cents_is_exact_and_rounds_half_up(amount, cents):
+    assert server.to_cents(amount) == cents
+
+
+def test_from_cents_round_trips():
+    for cents in (0, 1, 99, 1999, 123456):
+        assert server.to_cents(server.from_cents(cents)) == cents
+    assert server.from_cents(1999) == 19.99
+
+
+def test_price_cart_line_snapshots_the_product():
+    assert server.price_cart_line({**PRODUCT, 'price': 19.99}, 3) == {
+        'name': 'Sérum éclat',
+        'category': 'soins',
+        'unit_price_cents': 1999,
+        'line_total_cents': 5997,
+    }
+
+
+class CartItems:
+    """Stands for cart_items holding a single line, applying updates the way Mongo would."""
+
+    def __init__(self, line):
+        self.line = line
+
+    async def find_one_and_update(self, query, update, **kwargs):
+        for field, amount in update['$inc'].items():
+            self.line[field] = self.line.get(field, 0) + amount
+        self.line.update(update['$set'])
+        return dict(self.line)
+
+    async def update_many(self, query, pipeline):
+        # realign_cart_lines
+        self.line['line_total_cents'] = self.line['unit_price_cents'] * self.line['quantity']
+
+    async def find_one(self, query, projection=None):
+        return dict(self.line)
+
+    async def count_documents(self, query, limit=0):
+        return 1
+
+
+class Products:
+    async def find_one(self, query, projection=None):
+        return dict(PRODUCT)
+
+
+@pytest.fixture
+def cart(monkeypatch):
+    calls = []
+
+    async def apply_cart_delta(user_id, subtotal_cents, item_count):
+        calls.append(('delta', user_id, subtotal_cents, item_count))
+
+    async def recompute_cart(user_id):
+        calls.append(('recompute', user_id))
+
+    def add(line, quantity):
+        items = CartItems(line)
+        monkeypatch.setattr(server, 'db', type('Db', (), {'products': Products(), 'cart_items': items})())
+        monkeypatch.setattr(server, 'apply_cart_delta', apply_cart_delta)
+        monkeypatch.setattr(server, 'recompute_cart', recompute_cart)
+        result = asyncio.run(server.add_to_cart(server.CartItemAdd(product_id='p1', quantity=quantity), owner='u1'))
+        return result, items.line
+
+    return add, calls
+
+
+def cart_line(unit_price_cents, quantity):
+    return {
+        'id': 'l1', 'user_id': 'u1', 'product_id': 'p1', 'quantity': quantity,
+        'name': PRODUCT['name'], 'category': PRODUCT['category'],
+        'unit_price_cents': unit_price_cents, 'line_total_cents': unit_price_cents * quantity,
+        'updated_at': datetime.now(timezone.utc),
+    }
+
+
+def test_add_to_cart_shifts_the_totals_of_a_line_at_the_current_price(cart):
+    add, calls = cart
+
+    result, line = add(cart_line(1250, 2), 1)
+
+    assert (result.quantity, result.line_total_cents) == (3, 3750)
+    assert calls == [('delta', 'u1', 1250, 1)]
+
+
+def test_add_to_cart_realigns_a_line_priced_before_a_price_change(cart):
+    add, calls = cart
+
+    # Two units snapshotted at 10.00, the product now costs 12.50: the $inc
+    # alone would leave 2 x 10.00 + 12.50 on the line
+    result, line = add(cart_line(1000, 2), 1)
+
+    assert (result.quantity, result.unit_price_cents, result.line_total_cents) == (3, 1250, 3750)
+    assert line['line_total_cents'] == 3750
+    assert calls == [('recompute', 'u1')]
@@ -0,0 +1,94 @@
+import csv
+import io
+import json
+import zlib
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def order(n, created_at='2026-03-01T10:00:00+00:00'):
+    return {
+        'id': f'order-{n}',
+        'created_at': created_at,
+        'user_id': 'u1',
+        'total': 25.0,
+        'payment_status': 'paid',
+        'session_id': f'cs_{n}',
+        'items': [{'product_id': 'p1', 'name': 'Sérum', 'quantity': 2, 'price': 12.5}],
+    }
+
+
+TRANSACTIONS = {'order-1': {'id': 't1', 'status': 'complete', 'payment_status': 'paid', 'amount': 25.0, 'currency': 'eur'}}
+
+
+def test_ranges_are_day_bounds_sorted_and_merged():
+    assert server.export_ranges(['2026-03-10..2026-03-12', '2026-3-1', '2026-03-13..2026-03-14', '2026-03-11']) == [
+        ('2026-03-01', '2026-03-02'),
+        ('2026-03-10', '2026-03-15'),
+    ]
+
+
+@pytest.mark.parametrize('value', ['2026-02-30', '2026-03-05..2026-03-01', 'yesterday'])
+def test_invalid_ranges_are_rejected(value):
+    with pytest.raises(HTTPException) as exc:
+        server.export_ranges([value])
+    assert exc.value.status_code == 400
+
+
+def test_cursor_round_trips_and_resumes_after_its_order():
+    cursor = server.encode_export_cursor(order(7))
+
+    assert '=' not in cursor
+    assert server.decode_export_cursor(cursor) == ('2026-03-01T10:00:00+00:00', 'order-7')
+    query = server.export_query([('2026-03-01', '2026-03-02')], cursor)
+    assert query['$and'][1] == {'$or': [
+        {'created_at': {'$gt': '2026-03-01T10:00:00+00:00'}},
+        {'created_at': '2026-03-01T10:00:00+00:00', 'id': {'$gt': 'order-7'}},
+    ]}
+
+
+@pytest.mark.parametrize('cursor', ['not-base64!', 'bm90IGpzb24', server.encode_export_cursor(order(1))[:-4]])
+def test_invalid_cursor_is_rejected(cursor):
+    with pytest.raises(HTTPException) as exc:
+        server.decode_export_cursor(cursor)
+    assert exc.value.status_code == 400
+
+
+def test_csv_header_is_written_once():
+    encoder = server.ExportEncoder('csv', compress=False, header=True)
+    data = encoder.encode([order(1)], TRANSACTIONS) + encoder.encode([order(2)], {}) + encoder.finish()
+
+    rows = list(csv.reader(io.StringIO(data.decode())))
+    assert rows[0] == server.EXPORT_COLUMNS
+    assert [row[0] for row in rows[1:]] == ['order-1', 'order-2']
+    assert json.loads(rows[1][server.EXPORT_COLUMNS.index('items')])[0]['quantity'] == 2
+
+    # A resumed export asks for no header
+    resumed = server.ExportEncoder('csv', compress=False, header=False)
+    assert resumed.encode([order(3)], {}).decode().startswith('order-3,')
+
+
+def test_ndjson_rows_carry_their_transaction_and_cursor():
+    encoder = server.ExportEncoder('ndjson', compress=False, header=True)
+    rows = [json.loads(line) for line in encoder.encode([order(1), order(2)], TRANSACTIONS).decode().splitlines()]
+
+    assert rows[0]['transaction_status'] == 'complete'
+    assert rows[0]['item_count'] == 2
+    assert rows[1]['transaction_id'] is None
+    assert server.decode_export_cursor(rows[1]['cursor']) == ('2026-03-01T10:00:00+00:00', 'order-2')
+
+
+def test_partial_gzip_stream_decompresses_up_to_its_last_chunk():
+    encoder = server.ExportEncoder('ndjson', compress=True, header=True)
+    first = encoder.encode([order(1), order(2)], TRANSACTIONS)
+    second = encoder.encode([order(3)], {})
+
+    # Download cut after the first chunk: no gzip trailer, but every row is readable
+    partial = zlib.decompressobj(31).decompress(first)
+    assert [json.loads(line)['order_id'] for line in partial.decode().splitlines()] == ['order-1', 'order-2']
+
+    complete = zlib.decompress(first + second + encoder.finish(), 31)
+    assert [json.loads(line)['order_id'] for line in complete.decode().splitlines()] == ['order-1', 'order-2', 'order-3']
@@ -0,0 +1,242 @@
+import asyncio
+import io
+import os
+from pathlib import Path
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from PIL import Image
+
+import server
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+
+
+@pytest.fixture
+def client(tmp_path):
+    app = server.create_app(server.Settings(
+        mongo_url='mongodb://localhost:27017',
+        db_name='test_images',
+        image_cache_dir=str(tmp_path / 'image_cache')
+    ))
+    # Not entered as a context manager: the startup hooks (indexes, job
+    # workers) need a database, serving stored images does not
+    return TestClient(app)
+
+
+def store_fixture(client, name):
+    return client.app.state.runtime.image_cache.store_original((FIXTURES / name).read_bytes())
+
+
+@pytest.mark.parametrize('width', server.IMAGE_WIDTHS)
+@pytest.mark.parametrize('fmt', sorted(server.IMAGE_FORMATS))
+def test_variant_is_resized_and_encoded(client, width, fmt):
+    image_hash = store_fixture(client, 'landscape.jpg')
+
+    response = client.get(f'/api/images/{image_hash}/{width}.{fmt}')
+
+    assert response.status_code == 200
+    assert response.headers['content-type'] == server.IMAGE_FORMATS[fmt]
+    with Image.open(io.BytesIO(response.content)) as img:
+        assert img.format == fmt.upper()
+        # 1600x1000 source, aspect ratio kept
+        assert img.size == (width, width * 1000 // 1600)
+
+
+def test_variant_is_never_upscaled_and_flattened_for_jpeg(client):
+    image_hash = store_fixture(client, 'transparent.png')
+
+    response = client.get(f'/api/images/{image_hash}/1280.jpeg')
+
+    assert response.status_code == 200
+    with Image.open(io.BytesIO(response.content)) as img:
+        assert img.size == (300, 200)
+        assert img.mode == 'RGB'
+
+
+@pytest.mark.parametrize('variant', ['333.webp', '640.gif', '640', 'large.webp'])
+def test_unknown_variant_is_not_found(client, variant):
+    image_hash = store_fixture(client, 'landscape.jpg')
+    assert client.get(f'/api/images/{image_hash}/{variant}').status_code == 404
+
+
+def test_invalid_image_is_rejected(client):
+    with pytest.raises(HTTPException) as exc:
+        client.app.state.runtime.image_cache.store_original(b'not an image')
+    assert exc.value.status_code == 400
+
+
+def test_range_requests(client):
+    image_hash = store_fixture(client, 'landscape.jpg')
+    url = f'/api/images/{image_hash}/640.jpeg'
+    full = client.get(url).content
+    size = len(full)
+
+    response = client.get(url, headers={'Range': 'bytes=0-9'})
+    assert response.status_code == 206
+    assert response.headers['content-range'] == f'bytes 0-9/{size}'
+    assert response.content == full[:10]
+
+    response = client.get(url, headers={'Range': 'bytes=-5'})
+    assert response.status_code == 206
+    assert response.headers['content-range'] == f'bytes {size - 5}-{size - 1}/{size}'
+    assert response.content == full[-5:]
+
+    response = client.get(url, headers={'Range': 'bytes=10-'})
+    assert response.status_code == 206
+    assert response.content == full[10:]
+
+    response = client.get(url, headers={'Range': f'bytes=100-{size + 100}'})
+    assert response.status_code == 206
+    assert response.headers['content-range'] == f'bytes 100-{size - 1}/{size}'
+
+
+def test_unsatisfiable_range(client):
+    image_hash = store_fixture(client, 'landscape.jpg')
+    url = f'/api/images/{image_hash}/640.jpeg'
+    size = len(client.get(url).content)
+
+    response = client.get(url, headers={'Range': f'bytes={size}-'})
+    assert response.status_code == 416
+    assert response.headers['content-range'] == f'bytes */{size}'
+
+    # Malformed ranges are ignored and the whole file is served
+    response = client.get(url, headers={'Range': 'items=0-9'})
+    assert response.status_code == 200
+    assert len(response.content) == size
+
+
+def test_etag_and_not_modified(client):
+    image_hash = store_fixture(client, 'landscape.jpg')
+    url = f'/api/images/{image_hash}/320.webp'
+
+    response = client.get(url)
+    etag = response.headers['etag']
+    assert etag == f'"{image_hash}-320.webp"'
+    assert 'immutable' in response.headers['cache-control']
+
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.content == b''
+    assert response.headers['etag'] == etag
+
+
+def test_original_replaced_at_its_source_is_not_found(client, monkeypatch):
+    image_hash = 'a' * 64
+
+    class Images:
+        async def find_one(self, query, projection=None):
+            return {'hash': query['hash'], 'source_url': 'https://cdn.example.com/a.jpg'}
+
+    async def ingest_image_url(url):
+        # The source now serves other bytes, stored under their own hash
+        return store_fixture(client, 'transparent.png')
+
+    monkeypatch.setattr(server, 'db', type('Db', (), {'images': Images()})())
+    monkeypatch.setattr(server, 'ingest_image_url', ingest_image_url)
+
+    assert client.get(f'/api/images/{image_hash}/640.webp').status_code == 404
+
+
+def test_least_recently_used_variants_are_evicted(tmp_path):
+    cache = server.ImageCache(tmp_path, max_bytes=0)
+    image_hash = cache.store_original((FIXTURES / 'landscape.jpg').read_bytes())
+
+    first = cache.render_variant(image_hash, 320, 'jpeg')
+    os.utime(first, (0, 0))
+    cache.max_bytes = first.stat().st_size + 1
+    second = cache.render_variant(image_hash, 640, 'jpeg')
+
+    # The oldest variant goes, the one just rendered is always kept
+    assert not first.exists()
+    assert second.exists()
+    assert cache.original_path(image_hash).exists()
+
+    # Rendering again after eviction works from the original
+    assert cache.render_variant(image_hash, 320, 'jpeg').exists()
+
+
+@pytest.mark.parametrize('url', [
+    'http://127.0.0.1/image.jpg',
+    'http://10.0.0.5/image.jpg',
+    'http://169.254.169.254/latest/meta-data/',
+    'http://[::1]/image.jpg',
+    'file:///etc/passwd',
+    'ftp://example.com/image.jpg',
+])
+def test_source_images_are_only_fetched_from_public_http_urls(url):
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(server.fetch_source_image(url))
+    assert exc.value.status_code == 400
+
+
+@pytest.fixture
+def image_server():
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    seen = []
+    body = (FIXTURES / 'transparent.png').read_bytes()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            seen.append((self.path, self.headers['Host']))
+            if self.path == '/old.png':
+                self.send_response(302)
+                self.send_header('Location', '/new.png')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    httpd = HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_address[1], seen, body
+    httpd.shutdown()
+
+
+def test_source_image_is_fetched_from_the_checked_address(image_server, monkeypatch):
+    port, seen, body = image_server
+    resolved = []
+
+    async def resolve_public_address(url):
+        # Stands for a public name whose checked address is this local server
+        resolved.append(url.host)
+        return '127.0.0.1'
+
+    monkeypatch.setattr(server, 'resolve_public_address', resolve_public_address)
+
+    data = asyncio.run(server.fetch_source_image(f'http://images.example.test:{port}/old.png'))
+
+    assert data == body
+    # Every hop is checked again and keeps the original Host header
+    assert resolved == ['images.example.test', 'images.example.test']
+    assert seen == [('/old.png', f'images.example.test:{port}'), ('/new.png', f'images.example.test:{port}')]
+
+
+def test_product_srcset_is_absolute(client, monkeypatch):
+    image_hash = 'b' * 64
+
+    class Products:
+        async def find_one(self, query, projection=None):
+            return {
+                'id': query['id'], 'name': 'Sérum', 'description': '', 'price': 12.5, 'category': 'soins',
+                'stock': 3, 'image_url': 'https://cdn.example.com/serum.jpg', 'image_hash': image_hash,
+                'created_at': '2026-01-01T00:00:00+00:00'
+            }
+
+    monkeypatch.setattr(server, 'db', type('Db', (), {'products': Products()})())
+
+    srcset = client.get('/api/products/p1').json()['image_srcset']
+    assert srcset['webp'].split(', ')[0] == f'http://testserver/api/images/{image_hash}/320.webp 320w'
+
+    # A configured public URL wins over the one the request was made to
+    client.app.state.runtime.settings.backend_url = 'https://shop.example.com/'
+    srcset = client.get('/api/products/p2').json()['image_srcset']
+    assert srcset['jpeg'].split(', ')[-1] == f'https://shop.example.com/api/images/{image_hash}/1280.jpeg 1280w'
@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+import server
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(server.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def consume(backend, key, budget, times=1):
+    return [asyncio.run(backend.consume(key, budget)) for _ in range(times)]
+
+
+def test_bucket_allows_its_capacity_then_reports_the_wait(clock):
+    backend = server.InMemoryRateLimitBackend()
+    budget = server.RateBudget(capacity=3, refill_per_second=0.5)
+
+    assert consume(backend, 'k', budget, 3) == [0.0, 0.0, 0.0]
+    # Empty bucket: one token takes 1 / 0.5 seconds to come back
+    assert consume(backend, 'k', budget) == [2.0]
+
+    clock[0] += 1.5
+    assert consume(backend, 'k', budget) == [pytest.approx(0.5)]
+    # Buckets are independent
+    assert consume(backend, 'other', budget) == [0.0]
+
+
+def test_bucket_refills_up_to_its_capacity(clock):
+    backend = server.InMemoryRateLimitBackend()
+    budget = server.RateBudget(capacity=2, refill_per_second=1)
+    consume(backend, 'k', budget, 2)
+
+    clock[0] += 1
+    assert consume(backend, 'k', budget, 2) == [0.0, 1.0]
+
+    # A long pause never banks more than the capacity
+    clock[0] += 3600
+    assert consume(backend, 'k', budget, 3) == [0.0, 0.0, 1.0]
+
+
+def test_least_recently_used_buckets_are_dropped(clock):
+    backend = server.InMemoryRateLimitBackend(max_keys=2)
+    budget = server.RateBudget(capacity=1, refill_per_second=0.1)
+    consume(backend, 'a', budget)
+    consume(backend, 'b', budget)
+    consume(backend, 'c', budget)
+
+    # 'a' was forgotten and starts full again, 'c' is still empty
+    assert consume(backend, 'a', budget) == [0.0]
+    assert consume(backend, 'c', budget) == [10.0]
+
+
+@pytest.fixture
+def limiter(monkeypatch, clock):
+    monkeypatch.setattr(server, 'settings', server.Settings(mongo_url='mongodb://localhost:27017', db_name='test_rate_limit'))
+    monkeypatch.setattr(server, 'load_shedder', type('Shedder', (), {'overloaded': lambda self: False})())
+    monkeypatch.setattr(server, 'rate_limit_backend', server.InMemoryRateLimitBackend())
+
+
+def request_from(ip):
+    return Request({'type': 'http', 'method': 'POST', 'path': '/api/auth/login', 'headers': [], 'client': (ip, 50000)})
+
+
+def login_attempt(ip, email):
+    asyncio.run(server.enforce_rate_limit(request_from(ip), 'login', user_key=f'{ip}:{email}'))
+
+
+def test_exhausted_bucket_answers_429_with_retry_after(limiter):
+    for _ in range(5):
+        login_attempt('203.0.113.7', 'victim@example.com')
+
+    with pytest.raises(HTTPException) as exc:
+        login_attempt('203.0.113.7', 'Victim@example.com')
+    assert exc.value.status_code == 429
+    # 5 tokens a minute: the next one is 12 seconds away
+    assert exc.value.headers['Retry-After'] == '12'
+
+    # Another address can still log in to the same account
+    login_attempt('198.51.100.2', 'victim@example.com')
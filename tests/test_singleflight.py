@@ -0,0 +1,100 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+class SlowCall:
+    """A call that stays in flight until released, counting how often it ran."""
+
+    def __init__(self, result='catalog'):
+        self.result = result
+        self.release = asyncio.Event()
+        self.runs = 0
+
+    async def __call__(self):
+        self.runs += 1
+        await self.release.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+def test_concurrent_callers_share_one_execution():
+    async def scenario():
+        flight = server.SingleFlight()
+        call = SlowCall()
+        callers = [asyncio.create_task(flight.do('products', call)) for _ in range(10)]
+        await asyncio.sleep(0)
+        call.release.set()
+        results = await asyncio.gather(*callers)
+
+        assert results == ['catalog'] * 10
+        assert call.runs == 1
+        assert flight.stats()['coalesced'] == 9
+        assert flight.stats()['in_flight'] == 0
+
+        # Once settled, the next caller runs the call again
+        assert await flight.do('products', call) == 'catalog'
+        assert call.runs == 2
+
+    asyncio.run(scenario())
+
+
+def test_errors_reach_every_waiter():
+    async def scenario():
+        flight = server.SingleFlight()
+        call = SlowCall(ValueError('mongo down'))
+        callers = [asyncio.create_task(flight.do('products', call)) for _ in range(3)]
+        await asyncio.sleep(0)
+        call.release.set()
+        results = await asyncio.gather(*callers, return_exceptions=True)
+
+        assert all(isinstance(result, ValueError) for result in results)
+        assert call.runs == 1
+
+    asyncio.run(scenario())
+
+
+def test_waiters_beyond_the_cap_are_rejected():
+    async def scenario():
+        flight = server.SingleFlight(max_waiters=2)
+        call = SlowCall()
+        callers = [asyncio.create_task(flight.do('products', call)) for _ in range(2)]
+        await asyncio.sleep(0)
+
+        with pytest.raises(HTTPException) as exc:
+            await flight.do('products', call)
+        assert exc.value.status_code == 503
+        assert exc.value.headers['Retry-After'] == '1'
+        # Other keys are not affected
+        assert await flight.do('facets', lambda: asyncio.sleep(0, 'facets')) == 'facets'
+
+        call.release.set()
+        assert await asyncio.gather(*callers) == ['catalog', 'catalog']
+        assert flight.stats()['rejected'] == 1
+
+    asyncio.run(scenario())
+
+
+def test_cancelled_leader_does_not_cancel_followers():
+    async def scenario():
+        flight = server.SingleFlight()
+        call = SlowCall()
+        leader = asyncio.create_task(flight.do('products', call))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do('products', call))
+        await asyncio.sleep(0)
+
+        # The client that started the call disconnects
+        leader.cancel()
+        await asyncio.sleep(0)
+        call.release.set()
+
+        assert await follower == 'catalog'
+        assert leader.cancelled()
+        assert call.runs == 1
+
+    asyncio.run(scenario())